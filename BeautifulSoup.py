@@ -84,6 +84,8 @@ __copyright__ = "Copyright (c) 2004-2012 Leonard Richardson"
 __license__ = "New-style BSD"
 
 from sgmllib import SGMLParser, SGMLParseError
+from HTMLParser import HTMLParser
+from bisect import bisect_right
 import codecs
 import markupbase
 import types
@@ -129,6 +131,10 @@ class PageElement(object):
 
     XML_SPECIAL_CHARS_TO_ENTITIES = _invert(XML_ENTITIES_TO_SPECIAL_CHARS)
 
+    # The TagIndex this element was registered with while parsing, if
+    # the parser was asked to build one.
+    _tagIndex = None
+
     def setup(self, parent=None, previous=None):
         """Sets up the initial relations between this element and
         other elements."""
@@ -167,6 +173,8 @@ class PageElement(object):
 
     def extract(self):
         """Destructively rips this element out of the tree."""
+        if self._tagIndex is not None:
+            self._tagIndex.invalidate()
         if self.parent:
             try:
                 del self.parent.contents[self.parent.index(self)]
@@ -206,6 +214,9 @@ class PageElement(object):
             and not isinstance(newChild, NavigableString):
             newChild = NavigableString(newChild)
 
+        if self._tagIndex is not None:
+            self._tagIndex.invalidate()
+
         position =  min(position, len(self.contents))
         if hasattr(newChild, 'parent') and newChild.parent is not None:
             # We're 'inserting' an element that's already one
@@ -362,11 +373,12 @@ class PageElement(object):
                         if isinstance(element, Tag) and
                         element.name == name]
             else:
-                strainer = SoupStrainer(name, attrs, text, **kwargs)
+                strainer = compileStrainer(name, attrs, text, **kwargs)
         # Build a SoupStrainer
         else:
-            strainer = SoupStrainer(name, attrs, text, **kwargs)
+            strainer = compileStrainer(name, attrs, text, **kwargs)
         results = ResultSet(strainer)
+        match = strainer.compile()
         g = generator()
         while True:
             try:
@@ -374,7 +386,7 @@ class PageElement(object):
             except StopIteration:
                 break
             if i:
-                found = strainer.search(i)
+                found = match(i)
                 if found:
                     results.append(found)
                     if limit and len(results) >= limit:
@@ -503,34 +515,138 @@ class Declaration(NavigableString):
     def __str__(self, encoding=DEFAULT_OUTPUT_ENCODING):
         return "<!%s>" % NavigableString.__str__(self, encoding)
 
+class EntityDecoder(object):
+    """Precomputed tables for turning entity and character references
+    into text, for one combination of the convertHTMLEntities,
+    convertXMLEntities and escapeUnrecognizedEntities settings.
+
+    Every named entity is resolved once, when the tables are built,
+    instead of once per reference through a chain of tests. Use
+    forSettings() rather than the constructor, so that parsers and
+    tags with the same settings share one set of tables. A decoder is
+    pickled as its settings, and shared again once unpickled."""
+
+    ENTITY_REFERENCE = re.compile("&(#\d+|#x[0-9a-fA-F]+|\w+);")
+
+    _decoders = {}
+
+    def forSettings(cls, convertHTMLEntities, convertXMLEntities,
+                    escapeUnrecognizedEntities):
+        key = (bool(convertHTMLEntities), bool(convertXMLEntities),
+               bool(escapeUnrecognizedEntities))
+        decoder = cls._decoders.get(key)
+        if decoder is None:
+            decoder = cls._decoders[key] = cls(*key)
+        return decoder
+    forSettings = classmethod(forSettings)
+
+    def __init__(self, convertHTMLEntities, convertXMLEntities,
+                 escapeUnrecognizedEntities):
+        self.settings = (convertHTMLEntities, convertXMLEntities,
+                         escapeUnrecognizedEntities)
+        xmlEntities = PageElement.XML_ENTITIES_TO_SPECIAL_CHARS
+        self.convertCharrefs = convertHTMLEntities or convertXMLEntities
+
+        # Named references reported by the parser, where we can't tell
+        # whether a semicolon was present. See
+        # BeautifulStoneSoup.handle_entityref.
+        self.textEntities = {}
+        if convertXMLEntities:
+            self.textEntities.update(xmlEntities)
+        if convertHTMLEntities:
+            for name, codepoint in name2codepoint.items():
+                self.textEntities[name] = unichr(codepoint)
+            self.unknownTextEntity = u"&amp;%s"
+        else:
+            self.unknownTextEntity = u"&%s;"
+        for name in xmlEntities:
+            self.textEntities.setdefault(name, u"&%s;" % name)
+
+        # Complete references found in attribute values and text runs.
+        self.entities = {}
+        for name in xmlEntities:
+            if convertXMLEntities:
+                self.entities[name] = xmlEntities[name]
+            else:
+                self.entities[name] = u"&%s;" % name
+        if convertHTMLEntities:
+            for name, codepoint in name2codepoint.items():
+                self.entities[name] = unichr(codepoint)
+        if escapeUnrecognizedEntities:
+            self.unknownEntity = u"&amp;%s;"
+        else:
+            self.unknownEntity = u"&%s;"
+
+        get = self.entities.get
+        reference = self.reference
+        def substitute(match):
+            x = match.group(1)
+            return get(x) or reference(x)
+        self._substitute = substitute
+
+    def __reduce__(self):
+        # The substitution closure can't be pickled, and the tables
+        # needn't be
+        return (_entityDecoder, self.settings)
+
+    def textEntity(self, ref):
+        """Returns the text for an entity reference reported by the
+        parser."""
+        data = self.textEntities.get(ref)
+        if data is None:
+            data = self.unknownTextEntity % ref
+        return data
+
+    def charref(self, ref):
+        """Returns the text for a decimal character reference reported
+        by the parser."""
+        if self.convertCharrefs:
+            return unichr(int(ref))
+        return u"&#%s;" % ref
+
+    def reference(self, x):
+        """Returns the text for a complete reference, given what's
+        between the ampersand and the semicolon."""
+        data = self.entities.get(x)
+        if data is not None:
+            return data
+        if x[:1] == '#':
+            if x[1:2] == 'x':
+                return unichr(int(x[2:], 16))
+            return unichr(int(x[1:]))
+        return self.unknownEntity % x
+
+    def decode(self, text):
+        """Replaces all HTML, XML and numeric references in a run of
+        text with a single regular expression substitution."""
+        if '&' not in text:
+            return text
+        return self.ENTITY_REFERENCE.sub(self._substitute, text)
+
+def _entityDecoder(*settings):
+    # What unpickling an EntityDecoder calls: Python 2 can't pickle the
+    # bound forSettings() itself
+    return EntityDecoder.forSettings(*settings)
+
 class Tag(PageElement):
 
     """Represents a found HTML tag with its attributes and contents."""
 
+    # Document positions of this tag and of its last descendant tag, as
+    # assigned by a TagIndex.
+    _indexStart = None
+    _indexEnd = None
+
+    # How many pieces of markup renderGenerator() joins into each
+    # string it yields.
+    RENDER_CHUNK = 512
+
     def _convertEntities(self, match):
         """Used in a call to re.sub to replace HTML, XML, and numeric
         entities with the appropriate Unicode characters. If HTML
         entities are being converted, any unrecognized entities are
         escaped."""
-        x = match.group(1)
-        if self.convertHTMLEntities and x in name2codepoint:
-            return unichr(name2codepoint[x])
-        elif x in self.XML_ENTITIES_TO_SPECIAL_CHARS:
-            if self.convertXMLEntities:
-                return self.XML_ENTITIES_TO_SPECIAL_CHARS[x]
-            else:
-                return u'&%s;' % x
-        elif len(x) > 0 and x[0] == '#':
-            # Handle numeric entities
-            if len(x) > 1 and x[1] == 'x':
-                return unichr(int(x[2:], 16))
-            else:
-                return unichr(int(x[1:]))
-
-        elif self.escapeUnrecognizedEntities:
-            return u'&amp;%s;' % x
-        else:
-            return u'&%s;' % x
+        return self.entityDecoder.reference(match.group(1))
 
     def __init__(self, parser, name, attrs=None, parent=None,
                  previous=None):
@@ -553,13 +669,12 @@ class Tag(PageElement):
         self.convertHTMLEntities = parser.convertHTMLEntities
         self.convertXMLEntities = parser.convertXMLEntities
         self.escapeUnrecognizedEntities = parser.escapeUnrecognizedEntities
+        self.entityDecoder = parser.entityDecoder
 
         # Convert any HTML, XML, or numeric entities in the attribute values.
-        convert = lambda(k, val): (k,
-                                   re.sub("&(#\d+|#x[0-9a-fA-F]+|\w+);",
-                                          self._convertEntities,
-                                          val))
-        self.attrs = map(convert, self.attrs)
+        if attrs:
+            decode = self.entityDecoder.decode
+            self.attrs = [(k, decode(val)) for k, val in attrs]
 
     def getString(self):
         if (len(self.contents) == 1
@@ -573,15 +688,23 @@ class Tag(PageElement):
 
     string = property(getString, setString)
 
-    def getText(self, separator=u""):
+    def getText(self, separator=u"", strip=True):
+        """Returns all the strings in this tag joined by 'separator'.
+        Each string is stripped of surrounding whitespace first unless
+        'strip' is false, in which case this is the same as joining
+        findAll(text=True), only without going through a query."""
         if not len(self.contents):
             return u""
         stopNode = self._lastRecursiveChild().next
         strings = []
+        append = strings.append
         current = self.contents[0]
         while current is not stopNode:
             if isinstance(current, NavigableString):
-                strings.append(current.strip())
+                if strip:
+                    append(current.strip())
+                else:
+                    append(current)
             current = current.next
         return separator.join(strings)
 
@@ -640,6 +763,8 @@ class Tag(PageElement):
         if not found:
             self.attrs.append((key, value))
         self._getAttrMap()[key] = value
+        if key == 'class' and self._tagIndex is not None:
+            self._tagIndex.invalidate()
 
     def __delitem__(self, key):
         "Deleting tag[key] deletes all 'key' attributes for the tag."
@@ -651,6 +776,8 @@ class Tag(PageElement):
             self._getAttrMap()
             if self.attrMap.has_key(key):
                 del self.attrMap[key]
+        if key == 'class' and self._tagIndex is not None:
+            self._tagIndex.invalidate()
 
     def __call__(self, *args, **kwargs):
         """Calling a tag like a function is the same as calling its
@@ -701,7 +828,10 @@ class Tag(PageElement):
         NOTE: since Python's HTML parser consumes whitespace, this
         method is not certain to reproduce the whitespace present in
         the original string."""
+        return ''.join(self._render(encoding, prettyPrint, indentLevel))
 
+    def _renderStartTag(self, encoding):
+        """Returns the start tag and the end tag for this tag."""
         encodedName = self.toEncoding(self.name, encoding)
 
         attrs = []
@@ -749,34 +879,108 @@ class Tag(PageElement):
         else:
             closeTag = '</%s>' % encodedName
 
-        indentTag, indentContents = 0, 0
-        if prettyPrint:
-            indentTag = indentLevel
-            space = (' ' * (indentTag-1))
-            indentContents = indentTag + 1
-        contents = self.renderContents(encoding, prettyPrint, indentContents)
-        if self.hidden:
-            s = contents
+        attributeString = ''
+        if attrs:
+            attributeString = ' ' + ' '.join(attrs)
+        return '<%s%s%s>' % (encodedName, attributeString, close), closeTag
+
+    def renderGenerator(self, encoding=DEFAULT_OUTPUT_ENCODING,
+                        prettyPrint=False, indentLevel=0):
+        """Yields this tag's string representation, as returned by
+        __str__, a chunk at a time. This walks the tree without
+        recursion and never holds the whole document in memory, so it
+        works for arbitrarily deep trees and can be used to write huge
+        documents out piece by piece."""
+        return self._render(encoding, prettyPrint, indentLevel)
+
+    def _render(self, encoding, prettyPrint, indentLevel, contentsOnly=False):
+        # Each entry on the stack is a tag whose contents are being
+        # rendered: an iterator over the contents, the indent level for
+        # them, and for tags that aren't hidden, what's needed to close
+        # the tag. Pieces are collected in 'out' and handed out joined
+        # RENDER_CHUNK at a time; 'flushed' counts the pieces handed
+        # out so far and 'last' is the last of them. Only non-empty
+        # pieces go into 'out', so that's enough to tell whether (and
+        # how) the rendered contents of a tag end.
+        stack = []
+        out = []
+        append = out.append
+        flushed = 0
+        last = None
+
+        if contentsOnly:
+            stack.append((iter(self.contents), indentLevel, None))
+            tag = None
         else:
-            s = []
-            attributeString = ''
-            if attrs:
-                attributeString = ' ' + ' '.join(attrs)
-            if prettyPrint:
-                s.append(space)
-            s.append('<%s%s%s>' % (encodedName, attributeString, close))
-            if prettyPrint:
-                s.append("\n")
-            s.append(contents)
-            if prettyPrint and contents and contents[-1] != "\n":
-                s.append("\n")
-            if prettyPrint and closeTag:
-                s.append(space)
-            s.append(closeTag)
-            if prettyPrint and closeTag and self.nextSibling:
-                s.append("\n")
-            s = ''.join(s)
-        return s
+            tag = self
+        while True:
+            if tag is not None:
+                # Open a tag and start on its contents.
+                indentContents = 0
+                space = ''
+                if prettyPrint:
+                    space = ' ' * (indentLevel - 1)
+                    indentContents = indentLevel + 1
+                if tag.hidden:
+                    closing = None
+                else:
+                    startTag, closeTag = tag._renderStartTag(encoding)
+                    if space:
+                        append(space)
+                    append(startTag)
+                    if prettyPrint:
+                        append("\n")
+                    closing = (tag, flushed + len(out), space, closeTag)
+                stack.append((iter(tag.contents), indentContents, closing))
+                tag = None
+
+            if len(out) >= self.RENDER_CHUNK:
+                flushed += len(out)
+                last = out[-1]
+                yield ''.join(out)
+                del out[:]
+
+            if not stack:
+                break
+            contents, indentLevel, closing = stack[-1]
+            for c in contents:
+                if isinstance(c, NavigableString):
+                    text = c.__str__(encoding)
+                    if text and prettyPrint:
+                        text = text.strip()
+                    if text:
+                        if prettyPrint:
+                            if indentLevel > 1:
+                                append(" " * (indentLevel - 1))
+                            append(text)
+                            append("\n")
+                        else:
+                            append(text)
+                elif isinstance(c, Tag):
+                    if c.__class__.__str__.im_func is _tagStr:
+                        # Open it on the next trip round the outer loop.
+                        tag = c
+                        break
+                    text = c.__str__(encoding, prettyPrint, indentLevel)
+                    if text:
+                        append(text)
+            else:
+                # All the contents are rendered: close the tag.
+                stack.pop()
+                if closing is not None:
+                    closed, openedAt, space, closeTag = closing
+                    if prettyPrint and flushed + len(out) > openedAt:
+                        if (out and out[-1] or last)[-1] != "\n":
+                            append("\n")
+                    if closeTag:
+                        if space:
+                            append(space)
+                        append(closeTag)
+                        if prettyPrint and closed.nextSibling:
+                            append("\n")
+
+        if out:
+            yield ''.join(out)
 
     def decompose(self):
         """Recursively destroys the contents of this tree."""
@@ -802,22 +1006,8 @@ class Tag(PageElement):
                        prettyPrint=False, indentLevel=0):
         """Renders the contents of this tag as a string in the given
         encoding. If encoding is None, returns a Unicode string.."""
-        s=[]
-        for c in self:
-            text = None
-            if isinstance(c, NavigableString):
-                text = c.__str__(encoding)
-            elif isinstance(c, Tag):
-                s.append(c.__str__(encoding, prettyPrint, indentLevel))
-            if text and prettyPrint:
-                text = text.strip()
-            if text:
-                if prettyPrint:
-                    s.append(" " * (indentLevel-1))
-                s.append(text)
-                if prettyPrint:
-                    s.append("\n")
-        return ''.join(s)
+        return ''.join(self._render(encoding, prettyPrint, indentLevel,
+                                    contentsOnly=True))
 
     #Soup methods
 
@@ -843,6 +1033,11 @@ class Tag(PageElement):
         callable that takes a string and returns whether or not the
         string matches for some custom definition of 'matches'. The
         same is true of the tag name."""
+        if (recursive and text is None and not kwargs
+            and self._tagIndex is not None):
+            found = self._tagIndex.search(self, name, attrs, limit)
+            if found is not None:
+                return found
         generator = self.recursiveChildGenerator
         if not recursive:
             generator = self.childGenerator
@@ -884,6 +1079,7 @@ class Tag(PageElement):
             yield current
             current = current.next
 
+_tagStr = Tag.__str__.im_func
 
 # Next, a couple classes to represent queries and their results.
 class SoupStrainer:
@@ -1006,6 +1202,124 @@ class SoupStrainer:
                 result = matchAgainst == markup
         return result
 
+    def compile(self):
+        """Returns a function that behaves like search() for Tags and
+        strings, but with the name, attrs and text criteria turned into
+        specialized predicates once, instead of being re-interpreted
+        for every element visited."""
+        if self._compiled is None:
+            self._compiled = self._compile()
+        return self._compiled
+
+    _compiled = None
+
+    def _compileMatch(self, matchAgainst):
+        """Returns a predicate equivalent to
+        _matches(markup, matchAgainst) for a string (or None) markup."""
+        if matchAgainst is True:
+            return lambda markup: markup is not None
+        if callable(matchAgainst):
+            return matchAgainst
+        if isinstance(matchAgainst, basestring):
+            try:
+                uMatchAgainst = unicode(matchAgainst)
+            except UnicodeDecodeError:
+                uMatchAgainst = matchAgainst
+            def match(markup):
+                if isinstance(markup, unicode):
+                    return uMatchAgainst == markup
+                if isinstance(markup, str) or not markup:
+                    return matchAgainst == markup
+                return uMatchAgainst == unicode(markup)
+            return match
+        elif matchAgainst is None:
+            return lambda markup: markup is None
+        elif hasattr(matchAgainst, 'match'):
+            search = matchAgainst.search
+            def match(markup):
+                if markup and not isinstance(markup, basestring):
+                    markup = unicode(markup)
+                return (markup and search(markup)) or matchAgainst == markup
+            return match
+        elif isinstance(matchAgainst, (list, tuple, set, frozenset, dict)):
+            def match(markup):
+                if markup and not isinstance(markup, basestring):
+                    markup = unicode(markup)
+                return markup in matchAgainst or matchAgainst == markup
+            return match
+        return lambda markup: self._matches(markup, matchAgainst)
+
+    def _compile(self):
+        if self.name and not callable(self.name) and self.name is not True:
+            matchName = self._compileMatch(self.name)
+        else:
+            matchName = None
+        if callable(self.name):
+            callName = self.name
+        else:
+            callName = None
+        matchAttrs = [(attr, self._compileMatch(matchAgainst))
+                      for attr, matchAgainst in (self.attrs or {}).items()]
+        text = self.text
+        matchText = self._compileMatch(text)
+        search = self.search
+
+        def match(markup):
+            if isinstance(markup, Tag):
+                if text:
+                    return None
+                if callName is not None:
+                    if not callName(markup):
+                        return None
+                elif matchName is not None and not matchName(markup.name):
+                    return None
+                if matchAttrs:
+                    get = markup.get
+                    for attr, matchAttr in matchAttrs:
+                        if not matchAttr(get(attr)):
+                            return None
+                return markup
+            elif isinstance(markup, basestring):
+                if matchText(markup):
+                    return markup
+                return None
+            return search(markup)
+        return match
+
+# Strainers built by compileStrainer(), keyed by their arguments.
+_strainerCache = {}
+_STRAINER_CACHE_SIZE = 200
+
+def _strainerSignature(value):
+    """Returns a hashable stand-in for a strainer argument, or raises
+    TypeError if the argument can't safely be used as a cache key."""
+    if value is None or value is True or isinstance(value, basestring) \
+           or hasattr(value, 'match'):
+        return value
+    if isinstance(value, dict):
+        return tuple(sorted([(k, _strainerSignature(v))
+                             for k, v in value.items()]))
+    if callable(value):
+        return value
+    raise TypeError("Can't cache a strainer on %r" % (value,))
+
+def compileStrainer(name=None, attrs={}, text=None, **kwargs):
+    """Returns a SoupStrainer for the given arguments, reusing (and
+    keeping the compiled matcher of) an earlier one built from the same
+    arguments where possible."""
+    try:
+        key = (_strainerSignature(name), _strainerSignature(attrs),
+               _strainerSignature(text), _strainerSignature(kwargs))
+        strainer = _strainerCache.get(key)
+    except TypeError:
+        return SoupStrainer(name, attrs, text, **kwargs)
+    if strainer is None:
+        if len(_strainerCache) >= _STRAINER_CACHE_SIZE:
+            _strainerCache.clear()
+        strainer = _strainerCache[key] = \
+            SoupStrainer(name, attrs, text, **kwargs)
+    return strainer
+
 class ResultSet(list):
     """A ResultSet is just a list that keeps track of the SoupStrainer
     that created it."""
@@ -1013,6 +1327,95 @@ class ResultSet(list):
         list.__init__([])
         self.source = source
 
+class TagIndex:
+    """Maps tag names, and tag names combined with CSS classes, to the
+    tags that carry them, in document order.
+
+    A parser built with buildIndex=True registers every tag here as it
+    is created, so that findAll() and find() calls with a plain tag
+    name, optionally restricted to a single CSS class, can be answered
+    with two bisections instead of a walk over the subtree. Changing
+    the tree through the PageElement methods (insert(), extract(),
+    replaceWith() and so on), or setting or deleting tag['class'],
+    invalidates the index, after which searches go back to walking the
+    tree. Renaming a tag or editing its attrs list directly does not:
+    call the soup's dropIndex() before doing that."""
+
+    CLASS_TOKEN = re.compile(r'^[\w-]+$')
+
+    def __init__(self):
+        self.count = 0
+        self.valid = True
+        self.positions = {}
+        self.tags = {}
+
+    def _add(self, key, tag):
+        positions = self.positions.get(key)
+        if positions is None:
+            positions = self.positions[key] = []
+            self.tags[key] = []
+        positions.append(tag._indexStart)
+        self.tags[key].append(tag)
+
+    def add(self, tag):
+        """Registers a newly created tag. Must be called in document
+        order, before any of the tag's children are added."""
+        self.count += 1
+        tag._tagIndex = self
+        tag._indexStart = self.count
+        self._add(tag.name, tag)
+        classes = tag.get('class')
+        if classes:
+            for token in set(classes.split()):
+                self._add((tag.name, token), tag)
+
+    def close(self, tag):
+        """Records that no further descendants of the tag will be
+        added."""
+        tag._indexEnd = self.count
+
+    def invalidate(self):
+        self.valid = False
+        self.positions = {}
+        self.tags = {}
+
+    def search(self, within, name, attrs, limit=None):
+        """Returns the tags below 'within' that findAll(name, attrs)
+        would return, or None if the query can't be answered from the
+        index."""
+        if not self.valid or within._indexEnd is None \
+               or not name or not isinstance(name, basestring):
+            return None
+        exact = None
+        if not attrs:
+            key = name
+        elif isinstance(attrs, basestring):
+            if not self.CLASS_TOKEN.match(attrs):
+                return None
+            key = (name, attrs)
+        elif isinstance(attrs, dict) and len(attrs) == 1 \
+                 and isinstance(attrs.get('class'), basestring):
+            exact = attrs['class']
+            tokens = exact.split()
+            if not tokens:
+                return None
+            key = (name, tokens[0])
+        else:
+            return None
+
+        results = ResultSet(compileStrainer(name, attrs))
+        positions = self.positions.get(key)
+        if not positions:
+            return results
+        start = bisect_right(positions, within._indexStart)
+        end = bisect_right(positions, within._indexEnd)
+        for tag in self.tags[key][start:end]:
+            if exact is None or tag.get('class') == exact:
+                results.append(tag)
+                if limit and len(results) >= limit:
+                    break
+        return results
+
 # Now, some helper functions.
 
 def buildTagMap(default, *args):
@@ -1034,6 +1437,123 @@ def buildTagMap(default, *args):
             built[portion] = default
     return built
 
+_DECLARATION_SPACE = re.compile(r'<!\s+')
+
+def _massageTag(match):
+    """Makes the fixes of BeautifulStoneSoup.MARKUP_MASSAGE to a single
+    tag."""
+    tag = match.group(0)
+    if tag[-2:] == '/>':
+        tag = tag[:-2] + ' />'
+    if tag[1] == '!':
+        tag = _DECLARATION_SPACE.sub('<!', tag, 1)
+    return tag
+
+# Now, the tree builders, which tokenize markup for the parser classes.
+
+class TreeBuilder:
+    """A tree builder tokenizes markup and reports what it finds to a
+    soup object, through the same methods SGMLParser calls:
+    finish_starttag(), finish_endtag(), handle_data(),
+    handle_entityref(), handle_charref(), handle_comment(),
+    handle_decl() and handle_pi(). The soup decides what to do with
+    them, so tag nesting rules don't depend on the builder.
+
+    A builder is instantiated for each pass over the markup. Pass the
+    class as the 'builder' argument of a soup constructor to choose it
+    for that parse.
+
+    This base class tokenizes with sgmllib: as the soup classes are
+    SGMLParsers themselves, it just runs the soup's own tokenizer.
+    Subclasses that tokenize some other way override feed()."""
+
+    def __init__(self, soup):
+        self.soup = soup
+
+    def feed(self, markup):
+        SGMLParser.feed(self.soup, markup)
+
+class SGMLTreeBuilder(TreeBuilder):
+    """Tokenizes with sgmllib, the way the soup classes always have."""
+    pass
+
+class HTMLParserTreeBuilder(TreeBuilder, HTMLParser):
+    """Tokenizes with the standard library's HTMLParser, which is
+    considerably faster than sgmllib.
+
+    The tokens are reported to the soup the way sgmllib reports them,
+    so the resulting trees are the same for everything but markup so
+    broken that the two tokenizers disagree about where tags are. In
+    particular, attribute values only get the few conversions sgmllib
+    does, and the soup's QUOTE_TAGS rather than HTMLParser's own list
+    decide which tags contain unparsed text."""
+
+    CDATA_CONTENT_ELEMENTS = ()
+
+    # Maps soup classes to the names of the tags they have start_,
+    # end_ or do_ methods for.
+    _handledTags = {}
+
+    def __init__(self, soup):
+        TreeBuilder.__init__(self, soup)
+        HTMLParser.__init__(self)
+        # Hand data straight through to the soup.
+        self.handle_data = soup.handle_data
+        self.handle_entityref = soup.handle_entityref
+        self.handle_comment = soup.handle_comment
+        self.handle_decl = soup.handle_decl
+        self.handle_pi = soup.handle_pi
+
+        soupClass = soup.__class__
+        handled = self._handledTags.get(soupClass)
+        if handled is None:
+            handled = self._handledTags[soupClass] = (
+                set([m.split('_', 1)[1] for m in dir(soupClass)
+                     if m.startswith('start_') or m.startswith('do_')]),
+                set([m[4:] for m in dir(soupClass)
+                     if m.startswith('end_')]))
+        self.startHandled, self.endHandled = handled
+
+    def feed(self, markup):
+        HTMLParser.feed(self, markup)
+
+    def updatepos(self, i, j):
+        # We don't report line numbers, so don't bother counting lines.
+        return j
+
+    def handle_starttag(self, name, attrs):
+        attrs = [(key, value is None and key or value)
+                 for key, value in attrs]
+        soup = self.soup
+        if name in self.startHandled:
+            soup.finish_starttag(name, attrs)
+        else:
+            soup.unknown_starttag(name, attrs)
+        if soup.literal and soup.quoteStack and soup.quoteStack[-1] == name:
+            self.set_cdata_mode(name)
+
+    handle_startendtag = handle_starttag
+
+    def handle_endtag(self, name):
+        if name in self.endHandled or name in self.soup.stack:
+            self.soup.finish_endtag(name)
+        else:
+            self.soup.unknown_endtag(name)
+
+    def handle_charref(self, name):
+        if name[:1] in 'xX':
+            # sgmllib doesn't know hexadecimal references.
+            self.soup.handle_data(u'&#%s;' % name)
+        else:
+            self.soup.handle_charref(name)
+
+    def unknown_decl(self, data):
+        if data.startswith('CDATA['):
+            self.soup._toStringSubclass(data[6:], CData)
+
+    def unescape(self, value):
+        return SGMLParser.entity_or_charref.sub(self.soup._convert_ref, value)
+
 # Now, the parser classes.
 
 class BeautifulStoneSoup(Tag, SGMLParser):
@@ -1066,8 +1586,15 @@ class BeautifulStoneSoup(Tag, SGMLParser):
                        lambda x: '<!' + x.group(1) + '>')
                       ]
 
+    # Both fixes in MARKUP_MASSAGE apply to single tags, so the default
+    # massage can be done in one pass over the document, with one copy.
+    COMBINED_MARKUP_MASSAGE = (re.compile(r'<(?:!\s[^<>]*|[^<>]*/)>'),
+                               _massageTag)
+
     ROOT_TAG_NAME = u'[document]'
 
+    DEFAULT_BUILDER = SGMLTreeBuilder
+
     HTML_ENTITIES = "html"
     XML_ENTITIES = "xml"
     XHTML_ENTITIES = "xhtml"
@@ -1079,10 +1606,12 @@ class BeautifulStoneSoup(Tag, SGMLParser):
     # fancy Unicode spaces (usually non-breaking) should be left
     # alone.
     STRIP_ASCII_SPACES = { 9: None, 10: None, 12: None, 13: None, 32: None, }
+    ASCII_SPACES_ONLY = re.compile(r'[\t\n\x0c\r ]*\Z')
 
     def __init__(self, markup="", parseOnlyThese=None, fromEncoding=None,
                  markupMassage=True, smartQuotesTo=XML_ENTITIES,
-                 convertEntities=None, selfClosingTags=None, isHTML=False):
+                 convertEntities=None, selfClosingTags=None, isHTML=False,
+                 buildIndex=False, builder=None):
         """The Soup object is initialized as the 'root tag', and the
         provided markup (which can be a string or a file-like object)
         is fed into the underlying parser.
@@ -1106,9 +1635,18 @@ class BeautifulStoneSoup(Tag, SGMLParser):
 
         You can pass in a custom list of (RE object, replace method)
         tuples to get Beautiful Soup to scrub your input the way you
-        want."""
+        want.
+
+        If buildIndex is true, a TagIndex is built while parsing, which
+        speeds up repeated searches by tag name and CSS class.
+
+        The markup is tokenized by the TreeBuilder class passed in as
+        builder, or by DEFAULT_BUILDER (sgmllib) if there is none. Try
+        HTMLParserTreeBuilder for speed."""
 
         self.parseOnlyThese = parseOnlyThese
+        self.buildIndex = buildIndex
+        self.builder = builder or self.DEFAULT_BUILDER
         self.fromEncoding = fromEncoding
         self.smartQuotesTo = smartQuotesTo
         self.convertEntities = convertEntities
@@ -1135,6 +1673,9 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             self.convertXMLEntities = False
             self.convertHTMLEntities = False
             self.escapeUnrecognizedEntities = False
+        self.entityDecoder = EntityDecoder.forSettings(
+            self.convertHTMLEntities, self.convertXMLEntities,
+            self.escapeUnrecognizedEntities)
 
         self.instanceSelfClosingTags = buildTagMap(None, selfClosingTags)
         SGMLParser.__init__(self)
@@ -1176,8 +1717,12 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             if self.markupMassage:
                 if not hasattr(self.markupMassage, "__iter__"):
                     self.markupMassage = self.MARKUP_MASSAGE
-                for fix, m in self.markupMassage:
+                if self.markupMassage is BeautifulStoneSoup.MARKUP_MASSAGE:
+                    fix, m = self.COMBINED_MARKUP_MASSAGE
                     markup = fix.sub(m, markup)
+                else:
+                    for fix, m in self.markupMassage:
+                        markup = fix.sub(m, markup)
                 # TODO: We get rid of markupMassage so that the
                 # soup object can be deepcopied later on. Some
                 # Python installations can't copy regexes. If anyone
@@ -1186,11 +1731,13 @@ class BeautifulStoneSoup(Tag, SGMLParser):
                 del(self.markupMassage)
         self.reset()
 
-        SGMLParser.feed(self, markup)
+        self.builder(self).feed(markup)
         # Close out any unfinished strings and close all the open tags.
         self.endData()
         while self.currentTag.name != self.ROOT_TAG_NAME:
             self.popTag()
+        if self._tagIndex is not None:
+            self._tagIndex.close(self)
 
     def __getattr__(self, methodName):
         """This method routes method call requests to either the SGMLParser
@@ -1205,6 +1752,26 @@ class BeautifulStoneSoup(Tag, SGMLParser):
         else:
             raise AttributeError
 
+    def decompose(self):
+        """Destroys the whole tree, along with the parser state that
+        refers into it. Afterwards nothing from the document is part of
+        a reference cycle, so it's freed by reference counting as soon
+        as the last outside reference to it goes away, rather than by
+        the cyclic garbage collector at some later point."""
+        Tag.decompose(self)
+        del self.contents[:]
+        self.tagStack = []
+        self.quoteStack = []
+        self.currentTag = None
+        self.previous = None
+
+    def dropIndex(self):
+        """Stops answering searches from the TagIndex built while
+        parsing, if any, so changes the index doesn't notice can be
+        made to the tree."""
+        if self._tagIndex is not None:
+            self._tagIndex.invalidate()
+
     def isSelfClosingTag(self, name):
         """Returns true iff the given string is the name of a
         self-closing tag according to this parser."""
@@ -1220,9 +1787,14 @@ class BeautifulStoneSoup(Tag, SGMLParser):
         self.tagStack = []
         self.quoteStack = []
         self.pushTag(self)
+        if self.buildIndex:
+            self._tagIndex = TagIndex()
+            self._indexStart = 0
 
     def popTag(self):
         tag = self.tagStack.pop()
+        if tag._tagIndex is not None:
+            tag._tagIndex.close(tag)
 
         #print "Pop", tag.name
         if self.tagStack:
@@ -1239,7 +1811,7 @@ class BeautifulStoneSoup(Tag, SGMLParser):
     def endData(self, containerClass=NavigableString):
         if self.currentData:
             currentData = u''.join(self.currentData)
-            if (currentData.translate(self.STRIP_ASCII_SPACES) == '' and
+            if (self.ASCII_SPACES_ONLY.match(currentData) and
                 not set([tag.name for tag in self.tagStack]).intersection(
                     self.PRESERVE_WHITESPACE_TAGS)):
                 if '\n' in currentData:
@@ -1345,6 +1917,8 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             return
 
         tag = Tag(self, name, attrs, self.currentTag, self.previous)
+        if self._tagIndex is not None:
+            self._tagIndex.add(tag)
         if self.previous:
             self.previous.next = tag
         self.previous = tag
@@ -1394,54 +1968,22 @@ class BeautifulStoneSoup(Tag, SGMLParser):
 
     def handle_charref(self, ref):
         "Handle character references as data."
-        if self.convertEntities:
-            data = unichr(int(ref))
-        else:
-            data = '&#%s;' % ref
-        self.handle_data(data)
+        self.handle_data(self.entityDecoder.charref(ref))
 
     def handle_entityref(self, ref):
         """Handle entity references as data, possibly converting known
         HTML and/or XML entity references to the corresponding Unicode
-        characters."""
-        data = None
-        if self.convertHTMLEntities:
-            try:
-                data = unichr(name2codepoint[ref])
-            except KeyError:
-                pass
-
-        if not data and self.convertXMLEntities:
-                data = self.XML_ENTITIES_TO_SPECIAL_CHARS.get(ref)
-
-        if not data and self.convertHTMLEntities and \
-            not self.XML_ENTITIES_TO_SPECIAL_CHARS.get(ref):
-                # TODO: We've got a problem here. We're told this is
-                # an entity reference, but it's not an XML entity
-                # reference or an HTML entity reference. Nonetheless,
-                # the logical thing to do is to pass it through as an
-                # unrecognized entity reference.
-                #
-                # Except: when the input is "&carol;" this function
-                # will be called with input "carol". When the input is
-                # "AT&T", this function will be called with input
-                # "T". We have no way of knowing whether a semicolon
-                # was present originally, so we don't know whether
-                # this is an unknown entity or just a misplaced
-                # ampersand.
-                #
-                # The more common case is a misplaced ampersand, so I
-                # escape the ampersand and omit the trailing semicolon.
-                data = "&amp;%s" % ref
-        if not data:
-            # This case is different from the one above, because we
-            # haven't already gone through a supposedly comprehensive
-            # mapping of entities to Unicode characters. We might not
-            # have gone through any mapping at all. So the chances are
-            # very high that this is a real entity, and not a
-            # misplaced ampersand.
-            data = "&%s;" % ref
-        self.handle_data(data)
+        characters.
+
+        The lookup goes through the tables of self.entityDecoder. An
+        unknown reference is passed through as an unrecognized entity
+        reference, except when HTML entities are being converted.
+        Then, since the input "AT&T" reaches this method as "T" just
+        like "&carol;" reaches it as "carol", we can't tell whether a
+        semicolon was present. The more common case is a misplaced
+        ampersand, so the ampersand is escaped and the trailing
+        semicolon omitted."""
+        self.handle_data(self.entityDecoder.textEntity(ref))
 
     def handle_decl(self, data):
         "Handle DOCTYPEs and the like as Declaration objects."
@@ -1769,10 +2311,23 @@ class UnicodeDammit:
     def __init__(self, markup, overrideEncodings=[],
                  smartQuotesTo='xml', isHTML=False):
         self.declaredHTMLEncoding = None
-        self.markup, documentEncoding, sniffedEncoding = \
-                     self._detectEncoding(markup, isHTML)
         self.smartQuotesTo = smartQuotesTo
         self.triedEncodings = []
+
+        # If the caller already knows the encoding (say, from an HTTP
+        # Content-Type header) and the document decodes cleanly with
+        # it, there's no need to sniff or scan for declarations.
+        if markup != '' and not isinstance(markup, unicode):
+            self.markup = markup
+            for proposedEncoding in overrideEncodings:
+                u = self._convertFrom(proposedEncoding)
+                if u:
+                    self.unicode = u
+                    return
+            self.triedEncodings = []
+
+        self.markup, documentEncoding, sniffedEncoding = \
+                     self._detectEncoding(markup, isHTML)
         if markup == '' or isinstance(markup, unicode):
             self.originalEncoding = None
             self.unicode = unicode(markup)
@@ -25,8 +25,12 @@ class GoogleScholar(Source):
         'pubdate',
     ])
 
-    # def get_book_url(self, identifiers):
-    #     return 'googlescholar', 
+    def get_book_url(self, identifiers):
+        from calibre_plugins.googlescholar_metadata.scholar import ScholarQuerier
+        ref_id = identifiers.get('googlescholar', None)
+        if ref_id and ScholarQuerier.is_ref_id(ref_id):
+            return ('googlescholar', ref_id, ScholarQuerier.ARTICLE_URL % {'ref_id': ref_id})
+        return None
 
     def config_widget(self):
         '''
@@ -39,17 +43,22 @@ class GoogleScholar(Source):
             identifiers={}, timeout=30):
 
         import calibre_plugins.googlescholar_metadata.config as cfg
-        from calibre_plugins.googlescholar_metadata.worker import Worker
+        from calibre_plugins.googlescholar_metadata.worker import Worker, wake_on_abort
+        from calibre_plugins.googlescholar_metadata.scholar import ScholarQuerier
+
+        # With a known article, the worker only has to load its citation.
+        # Identifiers that are old BibTeX keys go through the search.
+        ref_id = identifiers.get('googlescholar', None)
+        if ref_id and not ScholarQuerier.is_ref_id(ref_id):
+            ref_id = None
 
         # Search for results in different thread, as searching takes time and blocks...
-        worker = Worker(result_queue, log, title, authors, self, cfg.getOption(cfg.KEY_MAX_DOWNLOADS))
+        worker = Worker(result_queue, log, title, authors, self, cfg.getOption(cfg.KEY_MAX_DOWNLOADS),
+                        cfg.getOption(cfg.KEY_MAX_AUTHORS), ref_id)
+        # Wake up as soon as the worker is done or calibre gives up on us
+        wake_on_abort(abort, worker.done)
         worker.start()
-
-        while not abort.is_set():
-        	worker.join(0.2)
-
-        	if not worker.is_alive():
-        		break
+        worker.done.wait()
 
         log.info('Out of worker: %s' % result_queue.qsize())
 
@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the HTML and BibTeX parsing done by this plugin.
+
+The benchmarks run on synthetic pages that mimic the Google Scholar
+results page layout, so they don't need network access. Run
+
+    python bench.py [name ...]
+
+to run the named benchmarks, or all of them if no name is given.
+"""
+
+import gc
+import multiprocessing
+import re
+import sys
+import time
+import timeit
+
+import bib
+
+from BeautifulSoup import BeautifulSoup, EntityDecoder, name2codepoint, \
+     SGMLTreeBuilder, HTMLParserTreeBuilder
+from scholar import ScholarParser120726, parse_pages
+
+RESULT_TEMPLATE = (
+    '<div class="gs_r"><div class="gs_ggs gs_fl">'
+    '<a href="http://example.org/%(i)d.pdf">[PDF]</a></div>'
+    '<div class="gs_ri"><h3 class="gs_rt">'
+    '<a href="http://example.org/paper%(i)d">%(title)s</a></h3>'
+    '<div class="gs_a">%(authors)s&nbsp;- Journal of Examples, %(year)d'
+    ' - example.org</div>'
+    '<div class="gs_rs">%(abstract)s</div>'
+    '<div class="gs_fl"><a href="/scholar?cites=%(i)d&amp;hl=en">'
+    'Cited by %(i)d</a> '
+    '<a href="/scholar?q=related:%(i)d:scholar.google.com/">'
+    'Related articles</a> '
+    '<a href="/scholar?cluster=%(i)d&amp;hl=en">All 3 versions</a> '
+    '<a href="#" onclick="return gs_ocit(event,\'ref%(i)d\',\'0\')">'
+    'Cite</a></div></div></div>\n')
+
+PAGE_HEADER = (
+    '<!DOCTYPE html><html><head>'
+    '<meta http-equiv="Content-Type" content="text/html;charset=UTF-8">'
+    '<title>Google Scholar</title>'
+    '<script>var s = "<div>"; if (a < b) { s += "</div>"; }</script>'
+    '</head><body><div id="gs_ccl">\n')
+
+PAGE_FOOTER = '</div></body></html>'
+
+def results_page(count=10, entities=False):
+    """Returns a results page with 'count' articles. If 'entities' is
+    true, titles, author lines and abstracts are full of entity and
+    character references."""
+    parts = [PAGE_HEADER]
+    for i in range(count):
+        if entities:
+            values = {
+                'title': 'Caf&eacute; &amp; Cr&egrave;me: Na&iuml;ve '
+                         '&ldquo;Bayes&rdquo; &#8211; Part %d&hellip;' % i,
+                'authors': 'J M&uuml;ller, A &Aring;str&ouml;m, '
+                           'B Fran&ccedil;ois',
+                'abstract': 'We show that P &lt; NP &amp;&amp; Q &gt; 0 '
+                            '&hellip; using &#955;-calculus &mdash; '
+                            '&ldquo;it works&rdquo; &amp; scales. ' * 4,
+            }
+        else:
+            values = {
+                'title': 'Cafe and Creme: Naive Bayes, Part %d' % i,
+                'authors': 'J Mueller, A Astrom, B Francois',
+                'abstract': 'We show that it works and scales. ' * 4,
+            }
+        values['i'] = i
+        values['year'] = 1990 + i % 20
+        parts.append(RESULT_TEMPLATE % values)
+    parts.append(PAGE_FOOTER)
+    return ''.join(parts)
+
+BIB_STRINGS = (
+    '@string{jex = "Journal of Examples"}\n'
+    '@string{feb = {February}}\n\n')
+
+BIB_TEMPLATE = (
+    '@article{key%(i)d,\n'
+    '  title = {{Caf\\\'e} and {C}reme: naive {B}ayes in {HTML5}, part %(i)d},\n'
+    '  author = {M\\"uller, Johann and van der Berg, Anna and Smith, Bob},\n'
+    '  journal = jex,\n'
+    '  month = feb,\n'
+    '  volume = {%(volume)d},\n'
+    '  number = "%(number)d",\n'
+    '  pages = {%(first)d--%(last)d},\n'
+    '  year = {%(year)d},\n'
+    '  publisher = {Example Press}\n'
+    '}\n\n')
+
+def bib_file(count=1000):
+    """Returns a .bib file with 'count' articles, after two @string
+    definitions they use."""
+    parts = [BIB_STRINGS]
+    for i in range(count):
+        parts.append(BIB_TEMPLATE % {
+            'i': i, 'volume': i % 40, 'number': i % 12 + 1,
+            'first': i * 10 + 1, 'last': i * 10 + 9, 'year': 1990 + i % 20})
+    return ''.join(parts)
+
+def report(label, seconds, number, unit='call'):
+    print '%-48s %10.1f us/%s' % (label, seconds * 1e6 / number, unit)
+
+def bench_entities(number=20):
+    """Parsing and decoding of entity-heavy results pages."""
+    page = results_page(100, entities=True)
+    for mode in (None, BeautifulSoup.HTML_ENTITIES,
+                 BeautifulSoup.XHTML_ENTITIES):
+        seconds = timeit.Timer(
+            lambda: BeautifulSoup(page, convertEntities=mode)).timeit(number)
+        report('parse, convertEntities=%s' % mode, seconds, number, 'page')
+
+    # The raw text runs of the page, as a parser in the default mode
+    # leaves them, decoded with a test chain per reference (the way
+    # Tag._convertEntities used to work) and with the precomputed
+    # tables of EntityDecoder.
+    runs = BeautifulSoup(page).findAll(text=True)
+    decoder = EntityDecoder.forSettings(True, False, True)
+    def branches(match):
+        x = match.group(1)
+        if x in name2codepoint:
+            return unichr(name2codepoint[x])
+        elif x in BeautifulSoup.XML_ENTITIES_TO_SPECIAL_CHARS:
+            return u'&%s;' % x
+        elif len(x) > 0 and x[0] == '#':
+            if len(x) > 1 and x[1] == 'x':
+                return unichr(int(x[2:], 16))
+            else:
+                return unichr(int(x[1:]))
+        else:
+            return u'&amp;%s;' % x
+    pattern = decoder.ENTITY_REFERENCE
+    seconds = timeit.Timer(
+        lambda: [pattern.sub(branches, run) for run in runs]).timeit(number)
+    report('decode text runs, test chain', seconds, number, 'page')
+    seconds = timeit.Timer(
+        lambda: [decoder.decode(run) for run in runs]).timeit(number)
+    report('decode text runs, tables', seconds, number, 'page')
+
+def bench_massage(number=50):
+    """Markup massage and whitespace checks on a results page."""
+    page = results_page(100).decode('utf-8')
+    fixes = BeautifulSoup.MARKUP_MASSAGE
+    def one_pass_per_fix():
+        markup = page
+        for fix, m in fixes:
+            markup = fix.sub(m, markup)
+        return markup
+    fix, m = BeautifulSoup.COMBINED_MARKUP_MASSAGE
+    print '%d kB page: %d copies one pass per fix, 1 copy combined' % (
+        len(page) * 2 / 1024, len(fixes))
+    seconds = timeit.Timer(one_pass_per_fix).timeit(number)
+    report('massage, one pass per fix', seconds, number, 'page')
+    seconds = timeit.Timer(lambda: fix.sub(m, page)).timeit(number)
+    report('massage, combined', seconds, number, 'page')
+
+    runs = [unicode(run) for run in BeautifulSoup(page).findAll(text=True)]
+    spaces = BeautifulSoup.STRIP_ASCII_SPACES
+    seconds = timeit.Timer(
+        lambda: [run.translate(spaces) == '' for run in runs]).timeit(number)
+    report('whitespace check, translate', seconds, number, 'page')
+    match = BeautifulSoup.ASCII_SPACES_ONLY.match
+    seconds = timeit.Timer(
+        lambda: [match(run) for run in runs]).timeit(number)
+    report('whitespace check, regex', seconds, number, 'page')
+
+def bench_builders(number=20):
+    """Parsing a results page with each tree builder."""
+    page = results_page(100)
+    for builder in (SGMLTreeBuilder, HTMLParserTreeBuilder):
+        seconds = timeit.Timer(
+            lambda: BeautifulSoup(page, builder=builder)).timeit(number)
+        report('parse, %s' % builder.__name__, seconds, number, 'page')
+
+def bench_render(number=20):
+    """Rendering a results page and extracting article titles."""
+    soup = BeautifulSoup(results_page(100))
+    seconds = timeit.Timer(lambda: str(soup)).timeit(number)
+    report('render', seconds, number, 'page')
+    seconds = timeit.Timer(lambda: soup.prettify()).timeit(number)
+    report('render, prettyPrint', seconds, number, 'page')
+
+    links = [h3.a for h3 in soup.findAll('h3')]
+    seconds = timeit.Timer(
+        lambda: [''.join(a.findAll(text=True)) for a in links]).timeit(number)
+    report('titles, findAll(text=True)', seconds, number, 'page')
+    seconds = timeit.Timer(
+        lambda: [a.getText(strip=False) for a in links]).timeit(number)
+    report('titles, getText', seconds, number, 'page')
+
+    depth = 5000
+    deep = BeautifulSoup('<div>' * depth + 'x' + '</div>' * depth)
+    seconds = timeit.Timer(lambda: str(deep)).timeit(number)
+    report('render, %d nested tags' % depth, seconds, number, 'page')
+
+def _parse_pages(keep_soup, pages, results):
+    """Parses 'pages' results pages in a fresh process, and reports
+    its memory use through the 'results' queue."""
+    import resource
+    page = results_page(10)
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.time()
+    parser = ScholarParser120726(keep_soup=keep_soup)
+    for i in xrange(pages):
+        parser.parse(page)
+    elapsed = time.time() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((elapsed, start, peak, gc.collect()))
+
+def bench_memory(pages=10000):
+    """Memory use while parsing many results pages."""
+    for keep_soup in (True, False):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_parse_pages, args=(keep_soup, pages, results))
+        process.start()
+        elapsed, start, peak, garbage = results.get()
+        process.join()
+        print ('keep_soup=%-5s %d pages in %.1fs, max RSS %d kB -> %d kB, '
+               '%d objects left for the garbage collector' %
+               (keep_soup, pages, elapsed, start, peak, garbage))
+
+def bench_bulk(pages=400):
+    """Parsing many results pages on a process pool."""
+    page = results_page(10)
+    serial = None
+    counts = [1, 2, 4, multiprocessing.cpu_count()]
+    for processes in sorted(set(counts)):
+        started = time.time()
+        for articles in parse_pages([page] * pages, processes):
+            pass
+        elapsed = time.time() - started
+        serial = serial or elapsed
+        print '%2d processes: %5.0f pages/s, speedup %.1fx' % (
+            processes, pages / elapsed, serial / elapsed)
+
+def bench_tokenizer(number=5):
+    """Tokenizing and parsing a large .bib file."""
+    data = bib_file(2000)
+    tokens = len(list(bib.Bibparser(data).tokenize()))
+
+    # Tokens as plain strings, classified by re.match calls the way
+    # Bibparser.value() used to, against the typed tokens.
+    token_re = re.compile(r"([^\s\"#%'(){}@,=]+|\n|@|\"|{|}|=|,)")
+    def by_match():
+        for item in token_re.finditer(data):
+            token = item.group(0)
+            if token == '\n':
+                continue
+            re.match(r"\w|#|,", token)
+            re.match(r"[^\w#]|,|}|{", token)
+            re.match(r"}|,", token)
+    def by_kind():
+        for kind, token in bib.Bibparser(data).tokenize():
+            kind == 'name'
+            kind != 'name'
+            kind == '}' or kind == ','
+    for label, classify in (('re.match per token', by_match),
+                            ('typed tokens', by_kind)):
+        seconds = timeit.Timer(classify).timeit(number)
+        print '%-48s %10.0f tokens/s' % (
+            'tokenize and classify, ' + label, tokens * number / seconds)
+
+    def parse():
+        bib.Bibparser(data).parse()
+    seconds = timeit.Timer(parse).timeit(number)
+    print '%-48s %10.0f tokens/s' % ('parse', tokens * number / seconds)
+
+def _stream_file(path, results):
+    """Parses the .bib file at 'path' entry by entry in a fresh
+    process, and reports its memory use through the 'results' queue."""
+    import resource
+    started = time.time()
+    count = 0
+    for key, record in bib.Bibparser(open(path)).iter_records():
+        count += 1
+    elapsed = time.time() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((count, elapsed, peak))
+
+def bench_stream(sizes=(10000, 100000)):
+    """Memory use while streaming records out of .bib files."""
+    import os
+    import tempfile
+    for count in sizes:
+        fd, path = tempfile.mkstemp(suffix='.bib')
+        try:
+            f = os.fdopen(fd, 'w')
+            for start in xrange(0, count, 1000):
+                f.write(bib_file(min(1000, count - start)))
+            f.close()
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_stream_file, args=(path, results))
+            process.start()
+            entries, elapsed, peak = results.get()
+            process.join()
+            print '%6d kB file: %d entries in %.1fs, max RSS %d kB' % (
+                os.path.getsize(path) / 1024, entries, elapsed, peak)
+        finally:
+            os.remove(path)
+
+def bench_titles(number=20):
+    """Capitalizing brace-protected words in titles."""
+    def rescanning(val):
+        # Bibparser.record used to do this, one protected group per pass
+        def capitalize(s):
+            return s.group(1) + s.group(2).upper()
+        while val.find('{') > -1:
+            caps = (val.find('{'), val.find('}'))
+            val = val.replace(val[caps[0]:caps[1]+1], re.sub("(^|\s)(\S)", capitalize, val[caps[0]+1:caps[1]]).strip())
+        return val
+    for groups in (2, 20, 200, 2000):
+        title = ' '.join(['word { w%d }' % i for i in range(groups)])
+        for label, capitalize in (('rescanning', rescanning),
+                                  ('single pass', bib.protect_capitals)):
+            seconds = timeit.Timer(lambda: capitalize(title)).timeit(number)
+            report('%4d groups, %s' % (groups, label), seconds, number,
+                   'title')
+
+def bench_bibparallel(entries=20000):
+    """Parsing a large .bib file on a process pool."""
+    # Macros used before they are defined must stay unexpanded, however
+    # the file is split up
+    late = ('@article{x, journal = later}\n'
+            '@string{later = "Defined Later"}\n'
+            '@article{y, journal = later}\n')
+    for data in (late.replace('\n', ' ') + '\n', late,
+                 late + bib_file(50) + late.replace('later', 'after')):
+        serial = bib.Bibparser(data)
+        serial.parse()
+        for processes in (2, 4):
+            parser = bib.Bibparser(data)
+            parser.parse_parallel(processes)
+            assert parser.records == serial.records, processes
+    data = bib_file(entries)
+    serial = None
+    counts = [1, 2, 4, multiprocessing.cpu_count()]
+    for processes in sorted(set(counts)):
+        parser = bib.Bibparser(data)
+        started = time.time()
+        if processes == 1:
+            parser.parse()
+        else:
+            parser.parse_parallel(processes)
+        elapsed = time.time() - started
+        serial = serial or elapsed
+        print '%2d processes: %6.0f entries/s, speedup %.1fx' % (
+            processes, entries / elapsed, serial / elapsed)
+
+def bench_names(number=5):
+    """Parsing author lists in which the same names keep coming back."""
+    people = ['Mueller, Johann', 'van der Berg, Anna', 'Bob Smith',
+              'Alexander Anderson', 'Ludwig van Beethoven', 'King, Jr, Martin']
+    fields = [' and '.join([people[(i + j) % len(people)]
+                            for j in range(i % 4 + 1)])
+              for i in range(5000)]
+    def by_substring(authors):
+        # Bibparser.parse_authors used to do this, on the substring 'and'
+        res = []
+        for author in authors.split('and'):
+            _author = author.split(',')
+            rec = {'family': _author[0].strip()}
+            if len(_author) > 1:
+                rec['given'] = _author[1].strip()
+            res.append(rec)
+        return res
+    for label, parse in (('split on substring, no cache', by_substring),
+                         ('name parser, no cache',
+                          lambda authors: bib.NameParser(0).parse_authors(authors)),
+                         ('name parser, LRU cache',
+                          bib.NameParser().parse_authors)):
+        seconds = timeit.Timer(
+            lambda: [parse(authors) for authors in fields]).timeit(number)
+        report(label, seconds, number * len(fields), 'field')
+
+def _parse_bib(compact, entries, results):
+    """Parses a .bib file of 'entries' entries in a fresh process, and
+    reports the memory its records take through the 'results' queue."""
+    import resource
+    data = bib_file(entries)
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.time()
+    parser = bib.Bibparser(data, compact=compact)
+    parser.parse()
+    elapsed = time.time() - started
+    del data, parser.data
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((elapsed, peak - start))
+
+def bench_compact(entries=100000):
+    """Memory taken by the records of a parsed .bib file."""
+    for compact in (False, True):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_parse_bib, args=(compact, entries, results))
+        process.start()
+        elapsed, used = results.get()
+        process.join()
+        print 'compact=%-5s %d entries in %.1fs, records take %d kB' % (
+            compact, entries, elapsed, used)
+
+def bench_index(entries=20000):
+    """Looking up a few keys in a large .bib file."""
+    import os
+    import tempfile
+    fd, path = tempfile.mkstemp(suffix='.bib')
+    try:
+        os.write(fd, bib_file(entries))
+        os.close(fd)
+        keys = ['key%d' % i for i in range(0, entries, entries // 5)]
+
+        started = time.time()
+        parser = bib.Bibparser(open(path))
+        parser.parse()
+        [parser.records[key] for key in keys]
+        report('full parse', time.time() - started, 1, 'lookup of 5')
+        for label in ('build index', 'load index'):
+            started = time.time()
+            index = bib.BibIndex(path)
+            report(label, time.time() - started, 1, 'file')
+            index.close()
+        index = bib.BibIndex(path)
+        seconds = timeit.Timer(lambda: index.lookup(keys)).timeit(20)
+        report('indexed', seconds, 20, 'lookup of 5')
+        index.close()
+    finally:
+        os.remove(path)
+        if os.path.exists(path + '.idx'):
+            os.remove(path + '.idx')
+
+def bench_incremental(entries=20000):
+    """Re-parsing a large .bib file after editing one entry."""
+    data = bib_file(entries)
+    edited = data.replace('part 17}', 'part seventeen}')
+    started = time.time()
+    bib.Bibparser(edited).parse()
+    report('full parse', time.time() - started, 1, 'parse')
+    parser = bib.IncrementalBibparser()
+    parser.parse(data)
+    started = time.time()
+    parser.parse(edited)
+    report('incremental, %d entry re-parsed' % parser.reparsed,
+           time.time() - started, 1, 'parse')
+
+def stub_citeproc(delay=0.0):
+    """Starts a stand-in for the citeproc server on a free local port,
+    which answers like it after 'delay' seconds, and returns it."""
+    import BaseHTTPServer
+    import json
+    import SocketServer
+    import threading
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            items = json.loads(body)['items']
+            time.sleep(delay)
+            page = json.dumps({'bibliography': [
+                {'entry_ids': [[item['id']] for item in items]},
+                ['<div class="csl-entry">%s</div>' % item.get('title')
+                 for item in items]]})
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+        def log_message(self, *args):
+            pass
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def bench_citeproc(entries=5000):
+    """Posting a bibliography to a stand-in citeproc server."""
+    parser = bib.Bibparser(bib_file(entries))
+    parser.parse()
+    records = [parser.records['key%d' % i] for i in range(entries)]
+    server = stub_citeproc(delay=0.05)
+    port = server.server_address[1]
+    for batch_size, connections in ((entries, 1), (500, 1), (500, 4)):
+        started = time.time()
+        entry_ids, formatted = bib.post_records(
+            records, batch_size, connections, port=port)
+        elapsed = time.time() - started
+        assert [ids[0] for ids in entry_ids] == \
+               [record['id'] for record in records]
+        report('batches of %d, %d connections' % (batch_size, connections),
+               elapsed, 1, 'post')
+    server.shutdown()
+
+def bench_convert(number=2000):
+    """Turning the BibTeX of one article into Metadata fields."""
+    bibtex = ('@article{mueller2010naive,\n'
+              '  title={Naive {B}ayes for {HTML5} documents},\n'
+              '  author={M{\\"u}ller, Johann and van der Berg, Anna and '
+              'Smith, Bob},\n'
+              '  journal={Journal of Examples},\n'
+              '  volume={12},\n'
+              '  number={3},\n'
+              '  pages={45--67},\n'
+              '  year={2010},\n'
+              '  publisher={Example Press}\n'
+              '}')
+    def per_article_parser():
+        # What Worker used to do for each article
+        parser = bib.Bibparser(bibtex)
+        parser.parse()
+        slug = parser.records.keys()[0]
+        record = parser.records[slug]
+        fields = {'id': slug, 'title': record.get('title'),
+                  'authors': [bib.name_parser.display(author)
+                              for author in record.get('author', [])]}
+        if 'publisher' in record:
+            fields['publisher'] = record['publisher']
+        if 'issued' in record:
+            fields['year'] = int(record['issued']['literal'])
+        return fields
+    converter = bib.MetadataConverter()
+    # Truncated or unreadable BibTeX keeps the fields before the damage
+    for broken in ('@article{k, title = ,}', '@article{k,\n title=',
+                   bibtex[:bibtex.index('journal')] + 'journal = ,}',
+                   bibtex[:bibtex.index('year') + 5]):
+        fields = converter.convert(broken)
+        assert fields['id'] in ('k', 'mueller2010naive'), broken
+        if fields['id'] != 'k':
+            assert len(fields['authors']) == 3, broken
+    for label, convert in (('Bibparser per article', per_article_parser),
+                           ('MetadataConverter',
+                            lambda: converter.convert(bibtex))):
+        seconds = timeit.Timer(convert).timeit(number)
+        report(label, seconds, number, 'article')
+
+BENCHMARKS = {
+    'bibparallel': bench_bibparallel,
+    'builders': bench_builders,
+    'citeproc': bench_citeproc,
+    'compact': bench_compact,
+    'convert': bench_convert,
+    'bulk': bench_bulk,
+    'entities': bench_entities,
+    'incremental': bench_incremental,
+    'index': bench_index,
+    'massage': bench_massage,
+    'memory': bench_memory,
+    'names': bench_names,
+    'render': bench_render,
+    'stream': bench_stream,
+    'titles': bench_titles,
+    'tokenizer': bench_tokenizer,
+}
+
+def main():
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        print '== %s: %s' % (name, BENCHMARKS[name].__doc__)
+        BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    main()
@@ -20,62 +20,645 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import bisect
 import fileinput
+import hashlib
+import mmap
+import os
 import re
 import json
+from collections import namedtuple, OrderedDict
 from pprint import pprint
 
+_comment_context = re.compile(r'[{}"%]')
+
 def clear_comments(data):
-    """Return the bibtex content without comments"""
-    res = re.sub(r"(%.*\n)", '', data)
-    res = re.sub(r"(comment [^\n]*\n)", '', res)
-    return res
+    """Return the bibtex content without % comments. A % only starts a
+    comment outside of entries and between the fields of an entry;
+    inside a braced or quoted value, as in an URL, it's kept. Bibparser
+    skips comments by itself, this is for other uses of the text"""
+    if '%' not in data :
+        return data
+    pieces = []
+    pos = 0
+    depth = 0
+    quoted = False
+    for match in _comment_context.finditer(data) :
+        at = match.start()
+        if at < pos :
+            # Inside a comment
+            continue
+        c = data[at]
+        if c == '{' :
+            depth += 1
+        elif c == '}' :
+            depth = max(depth - 1, 0)
+            quoted = quoted and depth > 0
+        elif c == '"' :
+            if depth == 1 :
+                quoted = not quoted
+        elif depth == 0 or depth == 1 and not quoted :
+            pieces.append(data[pos:at])
+            pos = data.find('\n', at)
+            if pos < 0 :
+                pos = len(data)
+    pieces.append(data[pos:])
+    return ''.join(pieces)
+
+_braces = re.compile(r"([{}])")
+_spaces = re.compile(r"(\s+)")
+
+def _capitalize_words(text) :
+    """Return the text stripped, with the first letter of every word
+    capitalized"""
+    text = text.strip()
+    words = _spaces.split(text)
+    if len(words) == 1 :
+        return text[:1].upper() + text[1:]
+    words[::2] = [word[:1].upper() + word[1:] for word in words[::2]]
+    return ''.join(words)
+
+def protect_capitals(title) :
+    """Return the title with each brace-protected group replaced by its
+    content, stripped, with the first letter of every word capitalized.
+    Groups may nest; an unclosed group runs to the end of the title and
+    a stray closing brace is kept as it is"""
+    if '{' not in title :
+        return title
+    # One list of pieces per open group, the whole title at the bottom
+    groups = [[]]
+    for piece in _braces.split(title) :
+        if piece == '{' :
+            groups.append([])
+        elif piece == '}' and len(groups) > 1 :
+            group = _capitalize_words(''.join(groups.pop()))
+            groups[-1].append(group)
+        elif piece :
+            groups[-1].append(piece)
+    while len(groups) > 1 :
+        group = _capitalize_words(''.join(groups.pop()))
+        groups[-1].append(group)
+    return ''.join(groups[0])
+
+class LRUCache(object) :
+    """A cache of at most size items that drops the least recently used
+    ones first. Items live in two generations of size / 2: a hit in the
+    old one moves the item to the new one, and when the new one is full
+    it becomes the old one, dropping the items that weren't used in the
+    meantime. That's only about LRU, but it costs a dict lookup or two
+    per access and needs no lock, as every step is a single dict
+    operation"""
+
+    def __init__(self, size) :
+        self.generation = max(size // 2, 1)
+        self.new = {}
+        self.old = {}
+
+    def get(self, key, default=None) :
+        try :
+            return self.new[key]
+        except KeyError :
+            pass
+        try :
+            value = self.old[key]
+        except KeyError :
+            return default
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value) :
+        new = self.new
+        new[key] = value
+        if len(new) >= self.generation :
+            self.old = new
+            self.new = {}
+
+_name_token = re.compile(r"[{}]|,|\s+|[^{},\s]+")
+_initial = re.compile(r"(?<![^ ])([A-Z])(?= |$)")
+
+class NameParser(object) :
+    """Parses BibTeX name lists into name records with a 'family' and,
+    if there is one, a 'given' and a 'suffix' name. Names are split on
+    the word 'and', and may be written "First von Last", "von Last,
+    First" or "von Last, Jr, First"; a von part stays with the family
+    name. Braces protect what's inside them from being split and are
+    dropped. The records of the size most recently parsed names are
+    cached, and parse_authors() hands out copies of them."""
+
+    def __init__(self, size=10000) :
+        self.lists = LRUCache(size)
+        self.names = LRUCache(size)
+        self.display_names = LRUCache(size)
+
+    def parse_authors(self, authors) :
+        """Returns the list of name records for a list of names"""
+        return map(dict, self._records(authors))
+
+    def display_authors(self, authors) :
+        """Returns the names in a list of names as display() gives them"""
+        return [self.display(rec) for rec in self._records(authors)]
+
+    def _records(self, authors) :
+        # The cached name records themselves, not to be handed out
+        recs = self.lists.get(authors)
+        if recs is None :
+            recs = []
+            for name in self.split(authors) :
+                rec = self.names.get(name)
+                if rec is None :
+                    rec = self.parse(name)
+                    self.names[name] = rec
+                recs.append(rec)
+            recs = tuple(recs)
+            self.lists[authors] = recs
+        return recs
+
+    def split(self, authors) :
+        """Returns the names in a list of names, each a list of parts
+        separated by commas, each of those a list of words"""
+        if '{' not in authors :
+            # The common case, without anything protected
+            names = []
+            name = []
+            for word in authors.replace(',', ' , ').split() :
+                if word.lower() == 'and' :
+                    if name :
+                        names.append(tuple(name))
+                    name = []
+                else :
+                    name.append(word)
+            if name :
+                names.append(tuple(name))
+            return names
+        names = []
+        name = []
+        word = []
+        depth = 0
+        for token in _name_token.findall(authors + ' ') :
+            if depth == 0 and (token == ',' or token[0].isspace()) :
+                if word :
+                    word = ''.join(word)
+                    if word.lower() == 'and' :
+                        if name :
+                            names.append(tuple(name))
+                        name = []
+                    else :
+                        name.append(word)
+                    word = []
+                if token == ',' :
+                    name.append(',')
+                continue
+            if token == '{' :
+                depth += 1
+            elif token == '}' :
+                depth = max(depth - 1, 0)
+            word.append(token)
+        if name :
+            names.append(tuple(name))
+        return names
+
+    def parse(self, name) :
+        """Returns the name record for a name, a sequence of words and
+        commas as returned by split()"""
+        parts = [[]]
+        for word in name :
+            if word == ',' :
+                parts.append([])
+            else :
+                parts[-1].append(self._clean(word))
+        words = parts[0]
+        if len(parts) == 1 :
+            # First von Last: the von part starts with the first word
+            # in lower case, but the last word is always the family name
+            first = len(words) - 1
+            for i, word in enumerate(words[:-1]) :
+                if self._lower(word) :
+                    first = i
+                    break
+            given, family = words[:first], words[first:]
+            suffix = []
+        elif len(parts) == 2 :
+            family, given = words, parts[1]
+            suffix = []
+        else :
+            family, suffix = words, parts[1]
+            given = [word for part in parts[2:] for word in part]
+        rec = {'family': ' '.join([w for w in family if w])}
+        if given :
+            rec['given'] = ' '.join([w for w in given if w])
+        if suffix :
+            rec['suffix'] = ' '.join([w for w in suffix if w])
+        return rec
+
+    def display(self, rec) :
+        """Returns the name of a record as "Given Family Suffix", with a
+        full stop after each initial of the given name"""
+        key = (rec.get('given'), rec['family'], rec.get('suffix'))
+        name = self.display_names.get(key)
+        if name is None :
+            given = rec.get('given')
+            if given :
+                name = '%s %s' % (_initial.sub(r'\1.', given),
+                                  rec['family'])
+            else :
+                name = rec['family']
+            if rec.get('suffix') :
+                name = '%s %s' % (name, rec['suffix'])
+            self.display_names[key] = name
+        return name
+
+    def _clean(self, word) :
+        if '{' in word or '}' in word :
+            word = ' '.join(word.replace('{', '').replace('}', '').split())
+        return word
+
+    def _lower(self, word) :
+        # Words starting with a brace have no case
+        for c in word :
+            if c.isalpha() :
+                return c.islower()
+            if c == '{' :
+                return False
+        return False
+
+# Names parsed by all the Bibparsers
+name_parser = NameParser()
+
+class MetadataConverter(object) :
+    """Turns a BibTeX entry, such as Google Scholar returns for an
+    article, straight into the fields of a calibre Metadata, in one pass
+    over the text and without a Bibparser. Values are taken as they are
+    written, with whitespace collapsed, so punctuation the Bibparser
+    tokenizer drops, like parentheses and apostrophes, is kept"""
+
+    head_re = re.compile(r"\s*@\s*([^\s\"#%'(){}@,=]+)\s*{\s*"
+                         r"([^\s\"#%'(){}@,=]*)\s*,?")
+    field_re = re.compile(r"\s*([^\s\"#%'(){}@,=]+)\s*=\s*")
+    bare_re = re.compile(r"[^\s\"#%'(){}@,=]+")
+    quoted_re = re.compile(r'[{}"]')
+    separator_re = re.compile(r"\s*(#|,|})?\s*")
+
+    def __init__(self, names=None) :
+        self.names = names or name_parser
+
+    def fields(self, bibtex) :
+        """Returns the type, the key and a dict of the raw fields of the
+        first entry in bibtex, or None if there's none. Field names are
+        in lower case, and braced values keep their inner braces"""
+        head = self.head_re.search(bibtex)
+        if not head :
+            return None
+        fields = {}
+        pos = head.end()
+        while True :
+            match = self.field_re.match(bibtex, pos)
+            if not match :
+                break
+            pieces = []
+            separator = None
+            pos = match.end()
+            while pos < len(bibtex) :
+                c = bibtex[pos]
+                if c == '{' or c == '"' :
+                    end = self._close(bibtex, pos)
+                    pieces.append(bibtex[pos + 1:end - 1])
+                else :
+                    bare = self.bare_re.match(bibtex, pos)
+                    if not bare :
+                        break
+                    end = bare.end()
+                    pieces.append(bare.group())
+                separator = self.separator_re.match(bibtex, end)
+                pos = separator.end()
+                if separator.group(1) != '#' :
+                    break
+            if not pieces :
+                # No value we can read: keep the fields before it
+                break
+            fields[match.group(1).lower()] = ''.join(pieces)
+            if (separator is None or not separator.group(1) or
+                separator.group(1) == '}') :
+                break
+        return head.group(1).lower(), head.group(2), fields
+
+    def convert(self, bibtex) :
+        """Returns a dict with the 'id', 'title', 'authors', 'publisher'
+        and 'year' (as an int) of the first entry in bibtex, leaving out
+        the ones it doesn't have, or None if there's no entry"""
+        entry = self.fields(bibtex)
+        if entry is None :
+            return None
+        fields = entry[2]
+        res = {'id': entry[1]}
+        if 'title' in fields :
+            res['title'] = protect_capitals(' '.join(fields['title'].split()))
+        names = self.names
+        res['authors'] = names.display_authors(fields.get('author', ''))
+        if 'publisher' in fields :
+            res['publisher'] = self._text(fields['publisher'])
+        year = fields.get('year', '').strip('{} ')
+        if year.isdigit() :
+            res['year'] = int(year)
+        return res
+
+    def _close(self, text, pos) :
+        """Returns the end of the braced or quoted value at pos"""
+        depth = 0
+        for match in self.quoted_re.finditer(text, pos) :
+            c = match.group()
+            if c == '{' :
+                depth += 1
+            elif c == '}' :
+                depth -= 1
+                if depth == 0 and text[pos] == '{' :
+                    return match.end()
+            elif depth == 0 and match.start() > pos :
+                return match.end()
+        return len(text)
+
+    def _text(self, value) :
+        return ' '.join(value.replace('{', '').replace('}', '').split())
+
+# How much of a file Bibparser reads at a time.
+BLOCK_SIZE = 1 << 16
+
+def iter_blocks(source, size=BLOCK_SIZE) :
+    """Returns an iterator over blocks of whole lines read from source,
+    a file object or any other iterable of lines, about size bytes at
+    a time"""
+    if hasattr(source, 'read') :
+        rest = []
+        while True :
+            chunk = source.read(size)
+            if not chunk :
+                break
+            end = chunk.rfind('\n') + 1
+            if end == 0 :
+                rest.append(chunk)
+                continue
+            rest.append(chunk[:end])
+            yield ''.join(rest)
+            rest = [chunk[end:]]
+        rest = ''.join(rest)
+        if rest :
+            yield rest
+    else :
+        lines = []
+        length = 0
+        for line in source :
+            lines.append(line)
+            length += len(line)
+            if length >= size :
+                yield ''.join(lines)
+                lines = []
+                length = 0
+        if lines :
+            yield ''.join(lines)
 
 def log( f ):    
     return f
 
+class Record(object) :
+    """A compact, read-only stand-in for the dict of a parsed entry, as
+    stored by a Bibparser in compact mode. Records with the same fields
+    share one tuple of interned field names, and the values are kept in
+    a tuple next to it. Author lists are shared between records as
+    tuples, but come out as new lists, just like in the dict"""
+
+    __slots__ = ('_keys', '_values')
+
+    # The tuples of field names in use, to share them between records
+    shapes = {}
+
+    def __init__(self, fields) :
+        keys = tuple([intern(key) for key, value in fields])
+        self._keys = self.shapes.setdefault(keys, keys)
+        self._values = tuple([value for key, value in fields])
+
+    def __getitem__(self, key) :
+        try :
+            return _unshare(self._values[self._keys.index(key)])
+        except ValueError :
+            raise KeyError(key)
+
+    def get(self, key, default=None) :
+        try :
+            return _unshare(self._values[self._keys.index(key)])
+        except ValueError :
+            return default
+
+    def __contains__(self, key) :
+        return key in self._keys
+
+    has_key = __contains__
+
+    def __iter__(self) :
+        return iter(self._keys)
+
+    def __len__(self) :
+        return len(self._keys)
+
+    def keys(self) :
+        return list(self._keys)
+
+    def values(self) :
+        return map(_unshare, self._values)
+
+    def items(self) :
+        return zip(self._keys, self.values())
+
+    def as_dict(self) :
+        """Returns the record as a dict, the way Bibparser stores it
+        when it isn't in compact mode"""
+        return dict(self.items())
+
+    def __eq__(self, other) :
+        if isinstance(other, Record) :
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other) :
+        return not self == other
+
+    def __repr__(self) :
+        return 'Record(%r)' % self.as_dict()
+
+def _unshare(value) :
+    # Only the shared author lists are tuples
+    if type(value) is tuple :
+        return list(value)
+    return value
+
 class Bibparser() :
     """Main class for Bibtex parsing"""
 
+    # One regex for all the tokens. The name of the group that matched
+    # is the kind of the token: 'name' for words that start with a
+    # letter, digit or underscore, 'text' for other words and 'punct'
+    # for the single characters of the grammar, whose kind is the
+    # character itself. Newlines are only matched to count lines, and a
+    # % starts a comment, unless it's inside a value.
+    token_re = re.compile(r"(?P<name>\w[^\s\"#'(){}@,=]*)"
+                          r"|(?P<text>[^\s\"#%'(){}@,=][^\s\"#'(){}@,=]*)"
+                          r"|(?P<nl>\n)"
+                          r"|(?P<punct>[@\"{}=,])"
+                          r"|(?P<comment>%[^\n]*)")
+    percent_re = re.compile(r"%[^\s\"#'(){}@,=]*")
+
     def tokenize(self) :
-        """Returns a token iterator"""        
-        for item in self.token_re.finditer(self.data):
-            i = item.group(0)
-            if self.white.match(i) :
-                if self.nl.match(i) :
-                    self.line += 1
-                continue
-            else :
-                yield i            
+        """Returns an iterator over (kind, token) pairs"""
+        if isinstance(self.data, basestring) :
+            blocks = [self.data]
+        else :
+            # Tokens never span lines, so blocks of whole lines can be
+            # tokenized one by one.
+            blocks = iter_blocks(self.data)
+        finditer = self.token_re.finditer
+        # Where we are, to tell comments from a % in a value: a comment
+        # is outside of entries or between fields, outside of quotes
+        depth = 0
+        quoted = False
+        for block in blocks :
+            pos = 0
+            while pos is not None :
+                restart = None
+                for item in finditer(block, pos):
+                    kind = item.lastgroup
+                    if kind == 'nl' :
+                        self.line += 1
+                        continue
+                    if kind == 'comment' :
+                        if depth == 0 or depth == 1 and not quoted :
+                            continue
+                        # A % in a value: it starts a word, and the rest
+                        # of the line is tokenized again after that
+                        word = self.percent_re.match(block, item.start())
+                        yield 'text', word.group()
+                        restart = word.end()
+                        break
+                    token = item.group()
+                    if kind == 'punct' :
+                        kind = token
+                        if token == '{' :
+                            depth += 1
+                        elif token == '}' :
+                            if depth > 0 :
+                                depth -= 1
+                            if depth == 0 :
+                                quoted = False
+                        elif token == '"' and depth == 1 :
+                            quoted = not quoted
+                    yield kind, token
+                pos = restart
 
-    def __init__(self, data) :
+    def __init__(self, data, macros=None, compact=False) :
+        """data is the bibtex as a string, or a file object or any other
+        iterable of lines to read it from as it's parsed. macros holds
+        @string definitions to start with. In compact mode, records are
+        stored as Records, which take a fraction of the memory of dicts,
+        and equal values are shared between them"""
         self.data = data    
         self.token = None
         self.token_type = None
         self._next_token = self.tokenize().next
-        self.hashtable = {}
+        self.hashtable = dict(macros) if macros else {}
         self.mode = None
         self.records = {}        
+        self.current = None
         self.line = 1
-
-        # compile some regexes
-        self.white = re.compile(r"[\n|\s]+")
-        self.nl = re.compile(r"[\n]")
-        self.token_re = re.compile(r"([^\s\"#%'(){}@,=]+|\n|@|\"|{|}|=|,)")
+        self.compact = compact
+        self.shared = {}
     
     def parse(self) :
         """Parses self.data and stores the parsed bibtex to self.rec"""
+        for key, record in self.iter_records() :
+            self.records[key] = record
+
+    def parse_parallel(self, processes=None, chunks_per_process=4) :
+        """Parses self.data on a pool of worker processes, one per CPU by
+        default, and stores the parsed bibtex to self.records, just as
+        parse() would. The data is split into about chunks_per_process
+        chunks per process at entry boundaries, and the @string macros
+        defined before each chunk are resolved beforehand and handed to
+        the worker that parses it"""
+        import multiprocessing
+        if not isinstance(self.data, basestring) :
+            self.data = ''.join(iter_blocks(self.data))
+        data = self.data
+        processes = processes or multiprocessing.cpu_count()
+        bounds = split_entries(data, processes * chunks_per_process)
+        if len(bounds) == 1 :
+            # A single chunk: parse it here, before any macro is known
+            self.parse()
+            return
+        chunks = []
+        for start, end in zip(bounds, bounds[1:] + [len(data)]) :
+            chunks.append((data[start:end], self.hashtable))
+            self.hashtable = string_macros(data, start, end, self.hashtable)
+        pool = multiprocessing.Pool(processes)
+        try :
+            for records in pool.imap(_parse_chunk, chunks) :
+                if self.compact :
+                    for key, record in records.iteritems() :
+                        self.records[key] = self.compact_record(record)
+                else :
+                    self.records.update(records)
+            pool.close()
+        finally :
+            pool.terminate()
+            pool.join()
+
+    def iter_records(self) :
+        """Parses self.data and yields a (key, record) pair for each entry
+        as soon as it is complete, without keeping it in self.records"""
         while True :
+            self.current = None
             try :
                 self.next_token()               
-                while self.database() :
-                    pass            
+                self.database()
             except StopIteration :
+                # The data ended inside an entry: keep what we've got
+                if self.current :
+                    yield self.finish_record()
                 break
+            if self.current :
+                yield self.finish_record()
+
+    def finish_record(self) :
+        """Returns the (key, record) pair of the entry just parsed"""
+        key, record = self.current
+        if self.compact :
+            record = self.compact_record(record)
+        return key, record
+
+    def compact_record(self, record) :
+        """Returns a Record for the dict of a parsed entry, sharing the
+        type, short values and author lists with the records before"""
+        shared = self.shared
+        fields = []
+        for key, value in sorted(record.iteritems()) :
+            if key == 'type' :
+                value = intern(value)
+            elif key == 'author' :
+                # Equal name records are shared, and so are the lists
+                # made of the same ones
+                names = [shared.setdefault(('name',) +
+                                           tuple(sorted(name.iteritems())),
+                                           name)
+                         for name in value]
+                value = shared.setdefault(tuple(map(id, names)),
+                                          tuple(names))
+            elif key == 'issued' :
+                literal = value.get('literal')
+                value = shared.setdefault(('issued', literal), value)
+            elif isinstance(value, basestring) and len(value) < 64 :
+                value = shared.setdefault(value, value)
+            fields.append((key, value))
+        return Record(fields)
     
     def next_token(self):
         """Returns next token"""        
-        self.token = self._next_token()
+        self.token_type, self.token = self._next_token()
         #print self.line, self.token
     
     @log
@@ -92,11 +675,26 @@ class Bibparser() :
             self.mode = 'string'
             self.string()
             self.mode = None
+        elif self.token.lower() == 'comment' :
+            self.comment()
         else :
             self.mode = 'record'            
             self.record()
             self.mode = None
 
+    @log
+    def comment(self) :
+        """Comment: skips its braces and everything in them"""
+        self.next_token()
+        if self.token == '{' :
+            depth = 1
+            while depth :
+                self.next_token()
+                if self.token == '{' :
+                    depth += 1
+                elif self.token == '}' :
+                    depth -= 1
+
     @log
     def string(self) :   
         """String"""   
@@ -155,14 +753,14 @@ class Bibparser() :
                     self.next_token()
                 else :
                     raise NameError("} missing")
-            elif self.token != "=" and re.match(r"\w|#|,", self.token) :
+            elif self.token_type == 'name' or self.token_type == ',' :
                 value = self.query_hashtable(self.token)
                 val.append(value)
                 while True:
                     self.next_token()                    
                     # if token is in hashtable then replace                    
                     value = self.query_hashtable(self.token)
-                    if re.match(r"[^\w#]|,|}|{", self.token) : #self.token == '' :
+                    if self.token_type != 'name' :
                         break
                     else :
                         val.append(value) 
@@ -177,7 +775,7 @@ class Bibparser() :
                     value = self.token          
                 self.next_token()
 
-            if re.match(r"}|,",self.token ) :
+            if self.token_type == '}' or self.token_type == ',' :
                 break            
 
         value = ' '.join(val)        
@@ -212,12 +810,16 @@ class Bibparser() :
             if self.token == '{' :
                 self.next_token()
                 key = self.key()
-                self.records[ key ] = {}
-                self.records[ key ]['type'] = record_type
-                self.records[ key ]['id'] = key
+                rec = {}
+                rec['type'] = record_type
+                rec['id'] = key
+                self.current = (key, rec)
                 if self.token == ',' :              
                     while True:
                         self.next_token()
+                        if self.token == '}' :
+                            # a comma after the last field
+                            break
                         field = self.field()
                         if field :
                             k = field[0]
@@ -236,14 +838,9 @@ class Bibparser() :
 
                             if k == 'title' :
                                 #   Preserve capitalization, as described in http://tex.stackexchange.com/questions/7288/preserving-capitalization-in-bibtex-titles
-                                #   This will likely choke on nested curly-brackets, but that doesn't seem like an ordinary practice.
-                                def capitalize(s):
-                                    return s.group(1) + s.group(2).upper()
-                                while val.find('{') > -1:
-                                    caps = (val.find('{'), val.find('}'))
-                                    val = val.replace(val[caps[0]:caps[1]+1], re.sub("(^|\s)(\S)", capitalize, val[caps[0]+1:caps[1]]).strip())
+                                val = protect_capitals(val)
                         
-                            self.records[ key ][k] = val
+                            rec[k] = val
                         if self.token != ',' :                      
                             break               
                     if self.token == '}' :
@@ -256,57 +853,429 @@ class Bibparser() :
                             raise NameError("@ missing")
 
     def parse_authors( self, authors ) :
-        res = []        
-        authors = authors.split('and')
-        for author in authors :
-            _author = author.split(',')
-            family = _author[0].strip().rstrip()
-            rec = {'family':family}
-            try :
-                given = _author[1].strip().rstrip()
-                rec['given'] = given
-            except IndexError:
-                pass
-            res.append( rec )
-        return res
+        """Returns the list of name records for a list of names"""
+        return name_parser.parse_authors(authors)
     
     def json(self) :
         """Returns json formated records"""
-        return json.dumps({'items':self.records.values()})
+        return json.dumps({'items':self.records.values()},
+                          default=Record.as_dict)
+
+    def write_json(self, f, ndjson=False) :
+        """Parses self.data and writes each record to f as soon as it is
+        parsed, without keeping it: one JSON object per line if ndjson,
+        else the document json() returns, written piece by piece. Unlike
+        json(), every entry is written, even if a later one has the same
+        key"""
+        dumps = json.JSONEncoder(default=Record.as_dict).encode
+        if ndjson :
+            for key, record in self.iter_records() :
+                f.write(dumps(record))
+                f.write('\n')
+            return
+        f.write('{"items": [')
+        separator = ''
+        for key, record in self.iter_records() :
+            f.write(separator)
+            f.write(dumps(record))
+            separator = ', '
+        f.write(']}')
+
+_entry_start = re.compile(r"\n[ \t]*@")
+_string_start = re.compile(r"@\s*string\s*{", re.I)
+
+def split_entries(data, count) :
+    """Returns the offsets at which to split data into about count
+    chunks, each starting with an @ entry. An @ at the start of a line
+    starts an entry if braces are balanced before it. An @ inside a
+    quoted value is inside the braces of its entry too, so counting
+    braces is enough, as long as quoted values have balanced braces
+    the way BibTeX wants them."""
+    size = max(len(data) // max(count, 1), 1)
+    bounds = [0]
+    pos = 0
+    depth = 0
+    target = size
+    while target < len(data) :
+        match = _entry_start.search(data, target)
+        if not match :
+            break
+        at = match.end() - 1
+        depth += data.count('{', pos, at) - data.count('}', pos, at)
+        pos = at
+        if depth <= 0 :
+            depth = 0
+            bounds.append(at)
+            target = at + size
+        else :
+            target = at + 1
+    return bounds
+
+def string_macros(data, start, end, macros) :
+    """Returns the @string macros in effect after data[start:end], given
+    the macros in effect before it"""
+    pos = start
+    depth = 0
+    for match in _string_start.finditer(data, start, end) :
+        at = match.start()
+        depth += data.count('{', pos, at) - data.count('}', pos, at)
+        pos = at
+        if depth > 0 :
+            continue
+        depth = 0
+        # Parse just this @string, up to its closing brace
+        close = end
+        level = 0
+        for brace in _braces.finditer(data, match.end() - 1, end) :
+            level += 1 if brace.group() == '{' else -1
+            if level == 0 :
+                close = brace.end()
+                break
+        parser = Bibparser(data[at:close], macros)
+        parser.parse()
+        macros = parser.hashtable
+    return macros
+
+def _parse_chunk(chunk) :
+    """Parses one chunk of Bibparser.parse_parallel() in a worker"""
+    data, macros = chunk
+    bib = Bibparser(data, macros)
+    bib.parse()
+    return bib.records
+
+_entry_head = re.compile(r"@\s*([^\s\"#%'(){}@,=]+)\s*{\s*([^\s\"#%'(){}@,=]*)")
+
+def entry_spans(data) :
+    """Returns an iterator over the (offset, length) of each @ entry in
+    data, a string or an mmap, found the way split_entries() finds
+    them. Each span runs up to the next entry"""
+    pos = 0
+    depth = 0
+    start = None
+    search = _entry_start.search
+    while True :
+        match = search(data, pos)
+        at = match.end() - 1 if match else len(data)
+        segment = data[pos:at]
+        if start is None :
+            # The first entry may start the data, without a newline
+            first = segment.find('@')
+            if first >= 0 and not segment[:first].strip() :
+                start = first
+        depth += segment.count('{') - segment.count('}')
+        pos = at
+        if depth <= 0 or not match :
+            depth = 0
+            if start is not None :
+                yield start, at - start
+            start = at
+        if not match :
+            break
+
+class BibIndex(object) :
+    """An index of the entries of a .bib file by key, for parsing only
+    the entries that are looked up. The index is built by scanning the
+    file through mmap once, and saved next to it in a sidecar file,
+    which is used as long as the size and mtime of the .bib match"""
+
+    def __init__(self, path, sidecar=None) :
+        self.path = path
+        self.sidecar = sidecar or path + '.idx'
+        self.entries = {}
+        self.strings = []
+        self._macros = None
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self.size, self.mtime = stat.st_size, stat.st_mtime
+        if self.size :
+            self.data = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        else :
+            self.data = ''
+        if not self.load() :
+            self.build()
+            self.save()
+
+    # Version of the sidecar format. The keys are bytes of the .bib in
+    # any encoding, so they are saved decoded as latin-1, which maps
+    # every byte to a character and back.
+    VERSION = 2
+
+    def load(self) :
+        """Reads the sidecar, if it's there and up to date"""
+        try :
+            with open(self.sidecar, 'rb') as f :
+                index = json.load(f)
+            if (index.get('version') != self.VERSION or
+                index.get('size') != self.size or
+                index.get('mtime') != self.mtime) :
+                return False
+            entries = dict((key.encode('latin-1'), tuple(span))
+                           for key, span in index['entries'].iteritems())
+            strings = [tuple(span) for span in index['strings']]
+        except (IOError, ValueError, UnicodeError) :
+            return False
+        self.entries, self.strings = entries, strings
+        return True
+
+    def build(self) :
+        """Scans the .bib for its entries"""
+        self.entries = {}
+        self.strings = []
+        data = self.data
+        for offset, length in entry_spans(data) :
+            match = _entry_head.match(data, offset, offset + length)
+            if not match :
+                continue
+            kind = match.group(1).lower()
+            if kind == 'string' :
+                self.strings.append((offset, length))
+            elif kind not in ('comment', 'preamble') :
+                # As in a parse, a later entry with a key wins
+                self.entries[match.group(2)] = (offset, length)
+
+    def save(self) :
+        """Writes the sidecar, if it can be written. Otherwise the index
+        is only kept in memory"""
+        entries = dict((key.decode('latin-1'), span)
+                       for key, span in self.entries.iteritems())
+        index = {'version': self.VERSION, 'size': self.size,
+                 'mtime': self.mtime, 'entries': entries,
+                 'strings': self.strings}
+        try :
+            text = json.dumps(index)
+            with open(self.sidecar, 'wb') as f :
+                f.write(text)
+        except (IOError, ValueError, UnicodeError) :
+            pass
+
+    def close(self) :
+        if self.size :
+            self.data.close()
+        self._file.close()
+
+    def __contains__(self, key) :
+        return key in self.entries
+
+    def __len__(self) :
+        return len(self.entries)
+
+    def keys(self) :
+        return self.entries.keys()
+
+    def get(self, key, default=None) :
+        """Returns the record of the entry with the key, parsed with the
+        @string macros defined before it"""
+        if key not in self.entries :
+            return default
+        offset, length = self.entries[key]
+        text = self.data[offset:offset + length]
+        bib = Bibparser(text, self.macros_at(offset))
+        for found, record in bib.iter_records() :
+            if found == key :
+                return record
+        return default
+
+    def __getitem__(self, key) :
+        record = self.get(key)
+        if record is None :
+            raise KeyError(key)
+        return record
+
+    def lookup(self, keys) :
+        """Returns a dict of the records of the keys that are found"""
+        records = {}
+        for key in keys :
+            record = self.get(key)
+            if record is not None :
+                records[key] = record
+        return records
+
+    def macros_at(self, offset) :
+        """Returns the @string macros defined before offset"""
+        if self._macros is None :
+            # Offsets of the @strings and the macros defined after each
+            self._macros = ([], [])
+            macros = {}
+            for start, length in self.strings :
+                text = self.data[start:start + length]
+                bib = Bibparser(text, macros)
+                bib.parse()
+                macros = bib.hashtable
+                self._macros[0].append(start)
+                self._macros[1].append(macros)
+        offsets, defined = self._macros
+        i = bisect.bisect_left(offsets, offset)
+        return defined[i - 1] if i else {}
+
+Delta = namedtuple('Delta', 'added removed changed')
+
+class IncrementalBibparser(object) :
+    """Parses successive versions of a .bib, re-parsing only the entries
+    whose text changed. Each entry's text is hashed, and the records
+    parsed from it are kept under the hash along with the @string
+    macros in effect, so entries that were moved, or whose macros
+    didn't change, are taken over as they are"""
+
+    def __init__(self) :
+        self.records = {}
+        self.hashtable = {}
+        self.parsed = {}
+        self.reparsed = 0
+
+    def parse(self, data) :
+        """Parses data, the whole .bib as a string, and stores the parsed
+        bibtex to self.records. Returns the Delta with the sets of keys
+        that were added, removed and changed since the last parse"""
+        records = {}
+        parsed = {}
+        macros = {}
+        state = self._state(macros)
+        self.reparsed = 0
+        for offset, length in entry_spans(data) :
+            text = data[offset:offset + length]
+            if isinstance(text, unicode) :
+                digest = hashlib.sha1(text.encode('utf-8')).digest()
+            else :
+                digest = hashlib.sha1(text).digest()
+            key = (digest, state)
+            result = self.parsed.get(key) or parsed.get(key)
+            if result is None :
+                bib = Bibparser(text, macros)
+                bib.parse()
+                result = (bib.records.items(), bib.hashtable)
+                self.reparsed += 1
+            parsed[key] = result
+            entries, after = result
+            records.update(entries)
+            if after != macros :
+                macros = after
+                state = self._state(macros)
+        old = self.records
+        delta = Delta(set(records) - set(old), set(old) - set(records),
+                      set([key for key in records if key in old and
+                           records[key] is not old[key] and
+                           records[key] != old[key]]))
+        self.records = records
+        self.hashtable = macros
+        self.parsed = parsed
+        return delta
+
+    def _state(self, macros) :
+        return hashlib.sha1(repr(sorted(macros.items()))).digest()
+
+# The citeproc server, and how many records to send it at a time over
+# how many connections
+CITEPROC_HOST = '127.0.0.1'
+CITEPROC_PORT = 8085
+CITEPROC_PATH = '/\?bibliography\=1\&citations\=1\&linkwrap\=1\&responseformat\=json\&showoutput\=1'
+BATCH_SIZE = 500
+CONNECTIONS = 4
+
+def post_records( records, batch_size=BATCH_SIZE, connections=CONNECTIONS,
+                  host=CITEPROC_HOST, port=CITEPROC_PORT ) :
+    """Posts records to the citeproc server in batches of batch_size,
+    over up to connections keep-alive connections at once. Returns the
+    entry ids and the formatted entries of the bibliography, merged in
+    the order of the records"""
+    import httplib
+    import threading
+    import Queue
+    batches = Queue.Queue()
+    count = 0
+    for start in xrange(0, len(records), batch_size) :
+        batches.put((count, records[start:start + batch_size]))
+        count += 1
+    results = [None] * count
+    errors = []
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    def post( connection, body ) :
+        connection.request('POST', CITEPROC_PATH, body, headers)
+        response = connection.getresponse()
+        page = response.read()
+        if response.status != 200 :
+            raise IOError('citeproc server said %d %s' %
+                          (response.status, response.reason))
+        return json.loads(page)['bibliography']
+
+    def work() :
+        connection = httplib.HTTPConnection(host, port)
+        try :
+            while not errors :
+                try :
+                    i, batch = batches.get_nowait()
+                except Queue.Empty :
+                    break
+                body = json.dumps({'items': batch}, default=Record.as_dict)
+                try :
+                    results[i] = post(connection, body)
+                except (httplib.HTTPException, IOError) :
+                    # The server may have closed the idle connection:
+                    # try once more on a new one
+                    connection.close()
+                    connection = httplib.HTTPConnection(host, port)
+                    results[i] = post(connection, body)
+        except Exception, e :
+            errors.append(e)
+        finally :
+            connection.close()
+
+    threads = [threading.Thread(target=work)
+               for i in xrange(max(min(connections, count), 1))]
+    for thread in threads :
+        thread.daemon = True
+        thread.start()
+    for thread in threads :
+        thread.join()
+    if errors :
+        raise errors[0]
+
+    entry_ids = []
+    entries = []
+    for bibliography in results :
+        entry_ids.extend(bibliography[0]['entry_ids'])
+        entries.extend(bibliography[1])
+    return entry_ids, entries
 
 def post_request( j ) :
-    import urllib
-    import urllib2
-    import json
-    url = 'http://127.0.0.1:8085/\?bibliography\=1\&citations\=1\&linkwrap\=1\&responseformat\=json\&showoutput\=1'
-    values = j    
-    req = urllib2.Request(url, values)
-    response = urllib2.urlopen(req)
-    the_page = response.read()
-    data=json.loads(the_page)
-
-    for i in xrange(len(data['bibliography'][1])) :
-        print data['bibliography'][0]['entry_ids'][i]
-        print data['bibliography'][1][i]
+    """Posts the records of j, as returned by Bibparser.json(), to the
+    citeproc server in batches, and prints the bibliography"""
+    print_bibliography(*post_records(json.loads(j)['items']))
+
+def print_bibliography( entry_ids, entries ) :
+    for i in xrange(len(entries)) :
+        print entry_ids[i]
+        print entries[i]
         print
-    
+
 def main() :
     """Main function"""
+    import optparse
+    import sys
+    usage = """bib.py [options] [file ...]
+Parses BibTeX from the files, or from standard input, and posts it to a
+citeproc server, or writes it out as JSON."""
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('--json', action='store_true',
+                      help='Write the records to standard output as JSON')
+    parser.add_option('--ndjson', action='store_true',
+                      help='Like --json, but one record per line')
+    options, args = parser.parse_args()
 
-    # TODO: Probably a solution with iterations will be better
-    data = ""
-    for line in fileinput.input():
-        line = line.rstrip()
-        data += line + "\n"
-
-    print 'loaded...'
-    data = clear_comments(data)
-    print 'cleared...'
-    bib = Bibparser(data)
-    bib.parse()
-    data = bib.json()
-    post_request( data )
-    #print data
+    # The input is parsed as it's read
+    bib = Bibparser(fileinput.input(args))
+    if options.json or options.ndjson :
+        # Records go out while the rest is still being parsed
+        bib.write_json(sys.stdout, ndjson=options.ndjson)
+        return
+    # Keep the records in file order, where a later entry with the
+    # same key takes the place of the first, as in bib.records
+    records = OrderedDict()
+    for key, record in bib.iter_records() :
+        records[key] = record
+    print 'parsed...'
+    print_bibliography(*post_records(records.values()))
     print 'done...'
     
 if __name__ == "__main__" :
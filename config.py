@@ -15,12 +15,14 @@ from calibre.utils.config import JSONConfig
 STORE_NAME = 'Options'
 # KEY_MAX_PAGES = 'maxPages'
 KEY_MAX_DOWNLOADS = 'maxDownloads'
+KEY_MAX_AUTHORS = 'maxAuthors'
 KEY_GET_ADDITIONAL_INFO = 'getAdditionalInfo'
 KEY_THRESHOLD = 'threshold'
 KEY_TRY_EXCHANGING = 'tryExchanging'
 
 DEFAULT_STORE_VALUES = {
     KEY_MAX_DOWNLOADS: 1,
+    KEY_MAX_AUTHORS: 1,
 }
 
 # This is where all preferences for this plugin will be stored
@@ -53,11 +55,24 @@ class ConfigWidget(DefaultConfigWidget):
         self.max_downloads_spin.setMaximum(100)
         self.max_downloads_spin.setProperty('value', c.get(KEY_MAX_DOWNLOADS, DEFAULT_STORE_VALUES[KEY_MAX_DOWNLOADS]))
         other_group_box_layout.addWidget(self.max_downloads_spin, 1, 1, 1, 1)
+
+        max_authors_label = QLabel('Authors to search for at the same time (1 = first author only):', self)
+        max_authors_label.setToolTip('With more than one, the first authors are searched\n'
+                             'for in parallel, along with the title alone, and\n'
+                             'the matches are merged. Helps when an author\n'
+                             'is misspelled or transliterated differently.\n')
+        other_group_box_layout.addWidget(max_authors_label, 2, 0, 1, 1)
+        self.max_authors_spin = QtGui.QSpinBox(self)
+        self.max_authors_spin.setMinimum(1)
+        self.max_authors_spin.setMaximum(10)
+        self.max_authors_spin.setProperty('value', c.get(KEY_MAX_AUTHORS, DEFAULT_STORE_VALUES[KEY_MAX_AUTHORS]))
+        other_group_box_layout.addWidget(self.max_authors_spin, 2, 1, 1, 1)
         other_group_box_layout.setColumnStretch(2, 1)
 
     def commit(self):
         DefaultConfigWidget.commit(self)
         new_prefs = {}
         new_prefs[KEY_MAX_DOWNLOADS] = int(unicode(self.max_downloads_spin.value()))
+        new_prefs[KEY_MAX_AUTHORS] = int(unicode(self.max_authors_spin.value()))
         plugin_prefs[STORE_NAME] = new_prefs
 
@@ -66,6 +66,7 @@ import sys
 import re
 import urllib
 import urllib2
+from threading import Thread
 from cookielib import CookieJar
 from BeautifulSoup import BeautifulSoup
 
@@ -122,18 +123,46 @@ class Article():
         """ Print only the bibtex output, ignore other collected information """
         return getattr(self, 'bibtex_string', '')
 
+    # The keys whose values make up an article record, in display order.
+    RECORD_KEYS = ('title', 'url', 'num_citations', 'num_versions',
+                   'url_citations', 'url_versions', 'bibtex_id', 'year')
+
+    def as_record(self):
+        """
+        Returns the values of the article's standard fields as a
+        tuple, in RECORD_KEYS order. Records are small and cheap to
+        pickle, which makes them the way to hand articles between
+        processes. Fields other than the standard ones are left out.
+        """
+        attrs = self.attrs
+        return tuple([attrs[key][0] if key in attrs else None
+                      for key in self.RECORD_KEYS])
+
+    @classmethod
+    def from_record(cls, record):
+        """ Builds an article from a tuple returned by as_record() """
+        art = cls()
+        for key, value in zip(cls.RECORD_KEYS, record):
+            art.attrs[key][0] = value
+        return art
+
 
 class ScholarParser():
     """
     ScholarParser can parse HTML document strings obtained from Google
     Scholar. It invokes the handle_article() callback on each article
     that was parsed successfully.
+
+    Once a document is parsed, its soup is taken apart so that it's
+    freed right away by reference counting. Pass keep_soup=True to
+    keep it around as self.soup instead.
     """
     SCHOLAR_SITE = 'http://scholar.google.com'
 
-    def __init__(self, site=None):
+    def __init__(self, site=None, keep_soup=False):
         self.soup = None
         self.article = None
+        self.keep_soup = keep_soup
         self.site = site or self.SCHOLAR_SITE
         self.year_re = re.compile(r'\b(?:20|19)\d{2}\b')
 
@@ -142,24 +171,33 @@ class ScholarParser():
         In this base class, the callback does nothing.
         """
 
-    def parse(self, html):
+    def parse(self, html, encoding=None):
         """
-        This method initiates parsing of HTML content.
+        This method initiates parsing of HTML content. If the encoding
+        of the document is known, e.g. from the HTTP headers, it is
+        tried before any encoding detection.
         """
-        self.soup = BeautifulSoup(html)
-        for div in self.soup.findAll(ScholarParser._tag_checker):
-            self._parse_article(div)
+        self.soup = BeautifulSoup(html, fromEncoding=encoding,
+                                  buildIndex=True)
+        try:
+            for div in self.soup.findAll('div', {'class': 'gs_r'}):
+                self._parse_article(div)
+        finally:
+            self._release_soup()
 
-    def parse_bibtex_link(self, html):
+    def parse_bibtex_link(self, html, encoding=None):
         """
         Extract the bibtex link from the AJAX page presented by google.
 
         Returns the bibtex link.
         """
-        self.soup = BeautifulSoup(html)
-        for a in self.soup.findAll('a'):
-            if a.get('href').startswith('/scholar.bib'):
-                return a.get('href')
+        self.soup = BeautifulSoup(html, fromEncoding=encoding)
+        try:
+            for a in self.soup.findAll('a'):
+                if a.get('href').startswith('/scholar.bib'):
+                    return a.get('href')
+        finally:
+            self._release_soup()
 
         return None
 
@@ -176,7 +214,7 @@ class ScholarParser():
 
             if tag.name == 'div' and tag.get('class') == 'gs_rt' and \
                     tag.h3 and tag.h3.a:
-                self.article['title'] = ''.join(tag.h3.a.findAll(text=True))
+                self.article['title'] = tag.h3.a.getText(strip=False)
                 self.article['url'] = self._path2url(tag.h3.a['href'])
 
             if tag.name == 'font':
@@ -214,11 +252,13 @@ class ScholarParser():
                     ref_id = re.search(".*event,'([\w-]+)'", tag.get('onclick')).group(1)
                     self.article['bibtex_id'] = ref_id
 
-    @staticmethod
-    def _tag_checker(tag):
-        if tag.name == 'div' and tag.get('class') == 'gs_r':
-            return True
-        return False
+    def _release_soup(self):
+        if not self.keep_soup:
+            self.soup.decompose()
+            self.soup = None
+        else:
+            # The soup is someone else's to change now
+            self.soup.dropIndex()
 
     def _as_int(self, obj):
         try:
@@ -247,7 +287,7 @@ class ScholarParser120201(ScholarParser):
                 continue
 
             if tag.name == 'h3' and tag.get('class') == 'gs_rt' and tag.a:
-                self.article['title'] = ''.join(tag.a.findAll(text=True))
+                self.article['title'] = tag.a.getText(strip=False)
                 self.article['url'] = self._path2url(tag.a['href'])
 
             if tag.name == 'div' and tag.get('class') == 'gs_a':
@@ -275,20 +315,97 @@ class ScholarParser120726(ScholarParser):
 
             if tag.name == 'div' and tag.get('class') == 'gs_ri':
               if tag.a:
-                self.article['title'] = ''.join(tag.a.findAll(text=True))
+                self.article['title'] = tag.a.getText(strip=False)
                 self.article['url'] = self._path2url(tag.a['href'])
 
-              if tag.find('div', {'class': 'gs_a'}):
-                year = self.year_re.findall(tag.find('div', {'class': 'gs_a'}).text)
+              authors = tag.find('div', {'class': 'gs_a'})
+              if authors:
+                year = self.year_re.findall(authors.text)
                 self.article['year'] = year[0] if len(year) > 0 else None
 
-              if tag.find('div', {'class': 'gs_fl'}):
-                self._parse_links(tag.find('div', {'class': 'gs_fl'}))
+              links = tag.find('div', {'class': 'gs_fl'})
+              if links:
+                self._parse_links(links)
 
         if self.article['title']:
             self.handle_article(self.article)
 
 
+# Process-wide parser of a parse_pages() worker process, and the
+# records of the articles found on the page it's working on.
+_worker_parser = None
+_worker_records = []
+
+def _init_worker(parser_class, site):
+    global _worker_parser
+    _worker_parser = parser_class(site)
+    _worker_parser.handle_article = \
+        lambda art: _worker_records.append(art.as_record())
+
+def _parse_page(page):
+    """
+    Parses one page in a parse_pages() worker and returns the records
+    of its articles.
+    """
+    if isinstance(page, tuple):
+        html, encoding = page
+    else:
+        html, encoding = page, None
+    try:
+        _worker_parser.parse(html, encoding)
+        return list(_worker_records)
+    finally:
+        del _worker_records[:]
+
+def parse_pages(pages, processes=None, chunksize=4,
+                parser_class=ScholarParser120726, site=None):
+    """
+    Parses many stored results pages on a pool of worker processes,
+    'processes' of them or one per CPU by default. 'pages' is an
+    iterable of HTML documents, or of (html, encoding) pairs when the
+    encoding of the pages is known. Pages are handed to the workers
+    'chunksize' at a time.
+
+    Returns an iterator over lists of the Article instances found on
+    each page, in the order of the pages. The workers send back
+    article records rather than soups, so little more than the
+    article data crosses the process boundary.
+    """
+    if processes == 1:
+        return _parse_pages_here(pages, parser_class, site)
+    return _parse_pages_in_pool(pages, processes, chunksize,
+                                parser_class, site)
+
+def _parse_pages_here(pages, parser_class, site):
+    # Not worth a pool: parse the pages right here, with a parser of
+    # our own, as other threads may be parsing too.
+    parser = parser_class(site)
+    articles = []
+    parser.handle_article = articles.append
+    for page in pages:
+        if isinstance(page, tuple):
+            html, encoding = page
+        else:
+            html, encoding = page, None
+        try:
+            parser.parse(html, encoding)
+            yield list(articles)
+        finally:
+            del articles[:]
+
+def _parse_pages_in_pool(pages, processes, chunksize, parser_class, site):
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (parser_class, site))
+    try:
+        for records in pool.imap(_parse_page, pages, chunksize):
+            yield [Article.from_record(record) for record in records]
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 class ScholarQuerier():
     """
     ScholarQuerier instances can conduct a search on Google Scholar
@@ -299,6 +416,14 @@ class ScholarQuerier():
     SCHOLAR_URL = 'http://scholar.google.com/scholar?hl=en&q=%(query)s+author:%(author)s&btnG=Search&as_subj=eng&as_sdt=1,5&as_ylo=&as_vis=0'
     NOAUTH_URL = 'http://scholar.google.com/scholar?hl=en&q=%(query)s&btnG=Search&as_subj=eng&as_std=1,5&as_ylo=&as_vis=0'
     BIBTEX_URL = 'http://scholar.google.com/scholar?q=info:%(ref_id)s:scholar.google.com/&output=cite&hl=de&as_sdt=0,5'
+    ARTICLE_URL = 'http://scholar.google.com/scholar?q=info:%(ref_id)s:scholar.google.com/&hl=en'
+    HOME_URL = 'http://scholar.google.com/?hl=en'
+
+    # The bibtex_id of an article is twelve characters of URL-safe
+    # base64, while Scholar makes BibTeX keys of the first author, the
+    # year and the first word of the title, all in lower case.
+    REF_ID_RE = re.compile(r'^[A-Za-z0-9_-]{12}$')
+    BIBTEX_KEY_RE = re.compile(r'^[a-z]+[0-9]{4}[a-z]*$')
 
     """
     Older URLs:
@@ -339,19 +464,60 @@ class ScholarQuerier():
         This method initiates a query with subsequent parsing of the
         response.
         """
+        for art in self.iter_query(search, bibtex):
+            pass
+
+    def iter_query(self, search, bibtex=False):
+        """
+        Like query(), but yields each article as soon as it is complete,
+        with its bibtex if requested, instead of waiting for all of
+        them. Articles that aren't asked for get no bibtex loaded.
+        """
+        self.search(search)
+
+        # After loading the result articles, get the bibtex, if requested
+        for art in list(self.articles):
+            if bibtex:
+                self._bibtech_query(art)
+            yield art
+
+
+    def search(self, search):
+        """
+        Loads and parses the results page only, without any bibtex.
+        """
         url = self.scholar_url % {'query': urllib.quote(search.encode('utf-8')), 'author': urllib.quote(self.author)}
 
         # This gets us the normal information, available from the google
         # scholar results page
         r = self.opener.open(url)
         html = r.read()
-        self.parse(html)
+        self.parse(html, r.info().getparam('charset'))
 
-        # After loading the result articles, get the bibtex, if requested
-        if bibtex:
-            for art in self.articles:
-                self._bibtech_query(art)
+    @classmethod
+    def is_ref_id(cls, value):
+        """
+        Tells a bibtex_id from the BibTeX keys that were used as article
+        identifiers before.
+        """
+        return bool(cls.REF_ID_RE.match(value) and
+                    not cls.BIBTEX_KEY_RE.match(value))
+
+    def citation(self, ref_id):
+        """
+        Loads the bibtex of the article with the given bibtex_id, as
+        found by an earlier search, without searching for it again.
+        Without a cookie from an earlier query, the home page is loaded
+        first to get one.
 
+        Returns an Article with just the bibtex_id and the bibtex.
+        """
+        if not len(self.CJ):
+            self.opener.open(self.HOME_URL).read()
+        art = Article()
+        art['bibtex_id'] = ref_id
+        self._bibtech_query(art)
+        return art
 
     def _bibtech_query(self, article):
         """
@@ -359,7 +525,8 @@ class ScholarQuerier():
         as we need a cookie from google. Then we need to aquire a unique
         identifier by loading an AJAX page before we can access the bibtex.
 
-        Returns the bibtex string
+        Returns the bibtex string. Raises IOError if the citation page has
+        no bibtex link.
         """
         url = self.BIBTEX_URL % { 'ref_id': article['bibtex_id'] }
 
@@ -369,7 +536,10 @@ class ScholarQuerier():
 
         # Now we extract the bibtex link with the unique identifier
         parser = ScholarParser()
-        bibtex_path = parser.parse_bibtex_link(cite_html)
+        bibtex_path = parser.parse_bibtex_link(cite_html,
+                                               r.info().getparam('charset'))
+        if bibtex_path is None:
+            raise IOError('No bibtex link for article %s' % article['bibtex_id'])
 
         url = 'http://scholar.google.com%(bibtex_path)s' % { 'bibtex_path': bibtex_path }
 
@@ -380,17 +550,62 @@ class ScholarQuerier():
         # Strip last newline and add information to article
         article.bibtex_string = bibtex_txt.rstrip(' \n')
 
-    def parse(self, html):
+    def parse(self, html, encoding=None):
         """
         This method allows parsing of existing HTML content.
         """
         parser = self.Parser(self)
-        parser.parse(html)
+        parser.parse(html, encoding)
 
     def add_article(self, art):
         self.articles.append(art)
 
 
+def iter_fan_out(search, authors, count=0, bibtex=False):
+    """
+    Searches restricted to each of 'authors' and once without any
+    author, all at the same time, and yields the articles found like
+    ScholarQuerier.iter_query() does. The lists are merged rank by
+    rank, so the best hits of every search come first, and an article
+    found by several searches is only yielded once, the first time its
+    bibtex_id turns up.
+
+    A search that fails is left out, unless all of them fail.
+    """
+    queriers = [ScholarQuerier(author=author, count=count)
+                for author in authors if author]
+    queriers.append(ScholarQuerier(count=count))
+    errors = []
+
+    def run(querier):
+        try:
+            querier.search(search)
+        except Exception, err:
+            errors.append(err)
+
+    threads = [Thread(target=run, args=(querier,)) for querier in queriers]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) == len(queriers):
+        raise errors[0]
+
+    seen = set()
+    for rank in range(max(len(q.articles) for q in queriers)):
+        for querier in queriers:
+            if rank >= len(querier.articles):
+                continue
+            art = querier.articles[rank]
+            key = art['bibtex_id'] or art['url'] or art['title']
+            if key in seen:
+                continue
+            seen.add(key)
+            if bibtex:
+                querier._bibtech_query(art)
+            yield art
+
 def bib(query, author, count):
     querier = ScholarQuerier(author=author, count=count)
     querier.query(query, True)
@@ -7,80 +7,133 @@ __license__   = 'GPL v3' #Based on B&N plugin by Grant Drake
 __copyright__ = '2013, Benjamin Behringer <mail at benjamin-behringer.de>'
 __docformat__ = 'en'
 
-import re
 import datetime
-from threading import Thread
+from itertools import islice
+from threading import Thread, Event
 from calibre.ebooks.metadata.book.base import Metadata
-from .scholar import ScholarQuerier
-from .bib import Bibparser
+from .scholar import ScholarQuerier, iter_fan_out
+from .bib import MetadataConverter, LRUCache
+
+def wake_on_abort(abort, event, interval=0.5):
+    '''
+    Set event when calibre sets abort, so a thread waiting on event wakes
+    up for either. A daemon thread watches abort until one of them is set,
+    and so ends at most interval seconds after event is set some other way.
+    '''
+    def wait():
+        while not event.is_set():
+            if abort.wait(interval):
+                event.set()
+    thread = Thread(target=wait)
+    thread.daemon = True
+    thread.start()
 
 class Worker(Thread): # Get details
     '''
     Download paper information from google scholar in separate thread.
     '''
 
-    def __init__(self, result_queue, log, query_title, query_authors, plugin, num=1):
+    # Shared by all workers: it keeps no state but its name cache
+    converter = MetadataConverter()
+    # BibTeX of the articles seen so far, by their bibtex_id
+    bibtex_cache = LRUCache(1000)
+
+    def __init__(self, result_queue, log, query_title, query_authors, plugin, num=1,
+                 max_authors=1, ref_id=None):
         Thread.__init__(self)
         self.daemon = True
+        # Set once run() returns, whatever happened, or on abort
+        self.done = Event()
         self.result_queue = result_queue
         self.log = log
         self.count = num
         self.plugin = plugin
-        self.query_title, self.query_authors = query_title, query_authors
+        self.query_title, self.query_authors = query_title, query_authors or []
+        self.max_authors = max_authors
+        # bibtex_id of the article, when calibre already has it
+        self.ref_id = ref_id
 
     def run(self):
         try:
             self._get_results()
         except:
             self.log.exception('_get_results failed')
+        finally:
+            self.done.set()
 
     def _get_results(self):
         """ Download Information from Google Scholar """
-        querier = ScholarQuerier(author=self.query_authors[0], count=self.count)
-        querier.query(self.query_title, bibtex=True)
-        articles = querier.articles
+        if self.ref_id and self._get_citation():
+            return
+
+        if self.max_authors > 1:
+            # Several authors and the title alone are searched at once
+            articles = iter_fan_out(self.query_title,
+                                    self.query_authors[:self.max_authors],
+                                    count=self.count, bibtex=True)
+        else:
+            author = self.query_authors[0] if self.query_authors else ''
+            querier = ScholarQuerier(author=author, count=self.count)
+            articles = querier.iter_query(self.query_title, bibtex=True)
         if self.count > 0:
-            articles = articles[:self.count]
+            # The bibtex of an article is loaded before it is yielded, so
+            # don't ask for one more than we want
+            articles = islice(articles, self.count)
+        # Each article is put in the queue as soon as its bibtex is here
         for num, art in enumerate(articles):
-            bibtex_string = art.as_bib()
-
-            bib = Bibparser(bibtex_string)
-            bib.parse()
-            slug = bib.records.keys()[0]
-            bib_dict = bib.records[slug]
-
-            title = bib_dict.get('title')
-
-            authors = []
-
-            for author in bib_dict.get('author', []):
-                # Ignore non existant given names
-                given_name = '%s ' % author.get('given') if 'given' in author else ''
-                # Add full stops after abbreviated name parts
-                given_name = re.sub(r'(^| +)([A-Z])( +|$)', r'\1\2.\3', given_name)
-
-                authors.append('%s%s' % (given_name, author['family']))
-
-            mi = Metadata(title, authors)
-
-            mi.set_identifier('googlescholar', slug)
-            mi.source_relevance = 100-num
-
-            if 'publisher' in bib_dict:
-                mi.publisher = bib_dict['publisher']
-
-            if 'issued' in bib_dict:
-                if 'literal' in bib_dict['issued']:
-                    year = int(bib_dict['issued']['literal'])
-
-                    from calibre.utils.date import utc_tz
-                    # We only have the year, so let's use Jan 1st
-                    mi.pubdate = datetime.datetime(year, 1, 1, tzinfo=utc_tz)
-
-            self.plugin.clean_downloaded_metadata(mi)
-            self._log_metadata(mi)
-            self.result_queue.put(mi, True)
-            self.log.info(self.result_queue.qsize())
+            if art['bibtex_id']:
+                self.bibtex_cache[art['bibtex_id']] = art.as_bib()
+            self._put(art.as_bib(), art['bibtex_id'], num)
+
+    def _get_citation(self):
+        """
+        Skip the search for an article we know the bibtex_id of: use the
+        bibtex we already have or load just that. Returns whether it worked.
+        """
+        try:
+            bibtex = self.bibtex_cache.get(self.ref_id)
+            if bibtex is None:
+                bibtex = ScholarQuerier().citation(self.ref_id).as_bib()
+                self.bibtex_cache[self.ref_id] = bibtex
+            return self._put(bibtex, self.ref_id, 0)
+        except:
+            self.log.exception('No citation for %s, searching instead' % self.ref_id)
+            return False
+
+    def _put(self, bibtex_string, ref_id, num):
+        """ Queue the Metadata of an article, returns whether there was any """
+        mi = self._to_metadata(bibtex_string, ref_id, num)
+        if mi is None:
+            return False
+
+        self.plugin.clean_downloaded_metadata(mi)
+        self._log_metadata(mi)
+        self.result_queue.put(mi, True)
+        self.log.info(self.result_queue.qsize())
+        return True
+
+    def _to_metadata(self, bibtex_string, ref_id, num):
+        """ Convert the BibTeX of an article to Metadata """
+        fields = self.converter.convert(bibtex_string)
+        if fields is None:
+            return None
+
+        # Authors come with full stops after abbreviated name parts
+        mi = Metadata(fields.get('title'), fields['authors'])
+
+        # The bibtex_id, unlike the BibTeX key, gets us the citation again
+        mi.set_identifier('googlescholar', ref_id or fields['id'])
+        mi.source_relevance = 100-num
+
+        if 'publisher' in fields:
+            mi.publisher = fields['publisher']
+
+        if 'year' in fields:
+            from calibre.utils.date import utc_tz
+            # We only have the year, so let's use Jan 1st
+            mi.pubdate = datetime.datetime(fields['year'], 1, 1, tzinfo=utc_tz)
+
+        return mi
 
     def _log_metadata(self, mi):
         self.log.info('-'*70)